@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from typing import Dict, Hashable, Set
+
+from throttling import TokenBucket
+
+# Решения слоя допуска нажатий "Участвую"
+ADMITTED = "admitted"
+RATE_LIMITED = "rate_limited"
+DUPLICATE = "duplicate"
+OVERLOADED = "overloaded"
+
+
+class ClickAdmission:
+    """
+    Допуск нажатий кнопки "Участвую" к полной обработке (чтение хранилища, запросы к Bot API).
+
+    - У каждого пользователя свое ведро токенов: частые повторные нажатия отклоняются сразу
+    - Одинаковые нажатия (пользователь, розыгрыш), пока первое еще обрабатывается, схлопываются в одно
+    - Количество одновременно обрабатываемых нажатий ограничено; лишние отклоняются дешевым ответом на callback
+
+    Все проверки выполняются в памяти за O(1). Ограничения действуют в пределах одного процесса бота.
+    """
+
+    def __init__(self, user_rate: float, user_burst: float, max_in_flight: int, max_tracked_users: int = 100_000):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_in_flight = max_in_flight
+        self.max_tracked_users = max_tracked_users
+        self._buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self._in_flight: Set[Hashable] = set()
+        self.counters: Dict[str, int] = {ADMITTED: 0, RATE_LIMITED: 0, DUPLICATE: 0, OVERLOADED: 0}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    def allow_user(self, user_id: int) -> bool:
+        """Проверяет частоту нажатий пользователя (ведро токенов)."""
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(rate=self.user_rate, capacity=self.user_burst)
+            self._buckets[user_id] = bucket
+            # Забываем самых давних пользователей, чтобы память не росла при наплыве
+            if len(self._buckets) > self.max_tracked_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+
+        if bucket.try_acquire():
+            return True
+        self.counters[RATE_LIMITED] += 1
+        return False
+
+    def begin(self, key: Hashable) -> str:
+        """
+        Регистрирует начало обработки нажатия key = (user_id, raffle_id).
+        Возвращает ADMITTED, DUPLICATE (такое же нажатие уже обрабатывается) или OVERLOADED.
+        """
+        if key in self._in_flight:
+            self.counters[DUPLICATE] += 1
+            return DUPLICATE
+        if len(self._in_flight) >= self.max_in_flight:
+            self.counters[OVERLOADED] += 1
+            return OVERLOADED
+
+        self._in_flight.add(key)
+        self.counters[ADMITTED] += 1
+        return ADMITTED
+
+    def end(self, key: Hashable) -> None:
+        """Отмечает окончание обработки нажатия."""
+        self._in_flight.discard(key)
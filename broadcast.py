@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from typing import Dict, List, Optional, Set, Tuple
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+import database as db
+from throttling import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Bot API ограничивает рассылку примерно 30 сообщениями в секунду, оставляем запас
+DEFAULT_RATE = 25.0
+
+# Количество одновременных запросов к Bot API
+DEFAULT_WORKERS = 16
+
+# Размер пакета: прогресс сохраняется после каждого пакета, при сбое не подтверждается не больше одного пакета
+BATCH_SIZE = 200
+
+# Сколько раз повторять отправку после ответа "слишком много запросов" (RetryAfter)
+MAX_RETRIES = 5
+
+# Как часто (в секундах) искать рассылки, брошенные упавшими процессами
+SUPERVISE_INTERVAL = 30
+
+
+def _owner_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+
+
+async def _send(bot: Bot, bucket: TokenBucket, semaphore: asyncio.Semaphore,
+                user_id: int, text: str) -> Tuple[int, Optional[str]]:
+    """Отправляет сообщение одному получателю. Возвращает (user_id, ошибка или None)."""
+    async with semaphore:
+        for _ in range(MAX_RETRIES):
+            await bucket.acquire()
+            try:
+                await bot.send_message(chat_id=user_id, text=text)
+                return user_id, None
+            except RetryAfter as e:
+                # Telegram просит подождать: приостанавливаем всю рассылку и повторяем
+                bucket.pause(float(e.retry_after))
+            except (Forbidden, BadRequest) as e:
+                # Пользователь заблокировал бота или не начинал с ним диалог - повтор не поможет
+                return user_id, str(e)
+            except TelegramError as e:
+                return user_id, str(e)
+        return user_id, "retry limit exceeded"
+
+
+class BroadcastRunner:
+    """
+    Исполнитель рассылок одного экземпляра бота.
+
+    Хранит рассылки, которые выполняет экземпляр, и общее для них ограничение скорости: одновременные
+    рассылки делят лимит Bot API. Экземпляр создается вместе с приложением и хранится в bot_data,
+    поэтому независимые экземпляры бота в одном процессе не мешают друг другу.
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE, workers: int = DEFAULT_WORKERS):
+        self.rate = rate
+        self.workers = workers
+        self._bucket = TokenBucket(rate=rate, capacity=rate)
+        self._running: Set[str] = set()
+        # Задачи рассылок, запущенных наблюдателем (ссылки хранятся, чтобы задачи не собрал сборщик мусора)
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def run(self, bot: Bot, job_id: str) -> None:
+        """
+        Выполняет (или продолжает после перезапуска) рассылку job_id.
+
+        Получатели читаются из хранилища по возрастанию ID, начиная с сохраненного курсора, и отправляются
+        пакетами через workers параллельных запросов с общим ограничением rate сообщений в секунду.
+        Перед отправкой пакет записывается как отправляемый, после - записываются результаты,
+        поэтому после сбоя рассылка продолжается без повторной отправки уже доставленных сообщений.
+        """
+        if job_id in self._running:
+            return
+
+        self._running.add(job_id)
+        try:
+            await self._run_claimed(bot, job_id)
+        finally:
+            self._running.discard(job_id)
+
+    async def _run_claimed(self, bot: Bot, job_id: str) -> None:
+        owner = _owner_id()
+        job = db.claim_broadcast(job_id, owner)
+        if not job:
+            return
+
+        semaphore = asyncio.Semaphore(self.workers)
+        recipients = db.iter_recipient_ids(job["raffle_id"], job["audience"], after=job["cursor"])
+        logger.info(f"Рассылка {job_id}: старт после получателя {job['cursor']}, отправлено ранее: {job['sent']}")
+
+        while True:
+            batch: List[int] = [user_id for _, user_id in zip(range(BATCH_SIZE), recipients)]
+            if not batch:
+                break
+
+            if not db.start_broadcast_batch(job_id, owner, batch):
+                logger.info(f"Рассылка {job_id} отменена или захвачена другим процессом")
+                return
+
+            results = await asyncio.gather(*(
+                _send(bot, self._bucket, semaphore, user_id, job["text"]) for user_id in batch
+            ))
+            sent = [user_id for user_id, error in results if error is None]
+            failures: Dict[int, str] = {user_id: error for user_id, error in results if error is not None}
+
+            if not db.finish_broadcast_batch(job_id, owner, sent, failures):
+                logger.info(f"Рассылка {job_id} отменена или захвачена другим процессом")
+                return
+
+        db.complete_broadcast(job_id, owner)
+        job = db.get_broadcast(job_id)
+        logger.info(f"Рассылка {job_id} завершена: отправлено {job['sent']}, ошибок {len(job['failed'])}")
+
+    async def supervise(self, bot: Bot) -> None:
+        """
+        Продолжает незавершенные рассылки: после перезапуска и когда истекает аренда рассылки упавшего процесса.
+        Рассылки, которые выполняют другие живые процессы, захватить не получится.
+
+        Каждая рассылка запускается отдельной задачей, поэтому длинная рассылка не задерживает остальные,
+        а ошибка (например, поврежденное задание) не останавливает наблюдателя.
+        """
+        while True:
+            try:
+                for job_id in db.get_unfinished_broadcast_ids():
+                    if job_id not in self._running:
+                        task = asyncio.create_task(self._run_supervised(bot, job_id))
+                        self._tasks.add(task)
+                        task.add_done_callback(self._tasks.discard)
+            except Exception as e:
+                logger.error(f"Не удалось проверить незавершенные рассылки: {e}")
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+
+    async def _run_supervised(self, bot: Bot, job_id: str) -> None:
+        try:
+            await self.run(bot, job_id)
+        except Exception as e:
+            logger.error(f"Рассылка {job_id} прервана ошибкой: {e}")
+
+
+def format_status(job: Dict) -> str:
+    """Текстовое описание состояния рассылки."""
+    statuses = {
+        db.BROADCAST_RUNNING: "выполняется",
+        db.BROADCAST_DONE: "завершена",
+        db.BROADCAST_CANCELLED: "отменена"
+    }
+    audiences = {"participants": "участники", "winners": "победители"}
+    return (
+        f"Рассылка {job['job_id']}\n"
+        f"Розыгрыш: {job['raffle_id']} ({audiences.get(job['audience'], job['audience'])})\n"
+        f"Статус: {statuses.get(job['status'], job['status'])}\n"
+        f"Отправлено: {job['sent']}\n"
+        f"Ошибок: {len(job['failed'])}\n"
+        f"Не подтверждено из-за сбоя: {len(job['unknown'])}"
+    )
@@ -0,0 +1,364 @@
+import hashlib
+import json
+import mmap
+import struct
+import sys
+from array import array
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+# Компактный двоичный формат участников канала (channels/<chat_id>/participants.bin).
+#
+# Заголовок:  magic "RBPS", версия, количество розыгрышей, длина таблицы ID розыгрышей,
+#             SHA-256 каталога и таблицы ID розыгрышей.
+# Каталог:    по записи на розыгрыш - положение ID розыгрыша и его секции, количество участников,
+#             SHA-256 секции.
+# Секция:     столбец user_id (int64, по возрастанию), столбец времени регистрации joined_at
+#             (int64, микросекунды от 1970-01-01 без часового пояса), столбец билетов (uint32, 0 - поле не задано),
+#             таблица профилей - JSON массив остальных полей участников в том же порядке.
+#             Время регистрации, которое нельзя сохранить в столбце без потерь (строка не в формате
+#             datetime.isoformat(), время с часовым поясом), остается в профиле.
+#
+# Все числа little-endian, столбцы выровнены на 8 байт. Файл читается через mmap: проверка участия
+# (двоичный поиск по столбцу ID), количество участников, список ID и время регистрации
+# не требуют разбора профилей.
+# Контрольная сумма секции проверяется, когда секция разбирается целиком.
+#
+# Конвертация без потерь: python compact.py to-compact participants.json participants.bin
+#                         python compact.py to-json participants.bin participants.json
+
+MAGIC = b'RBPS'
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct('<4sHHIQ32s')
+_ENTRY = struct.Struct('<QIIQQQQQ32s')
+_ID = struct.Struct('<q')
+_JOINED_AT = struct.Struct('<q')
+_TICKETS = struct.Struct('<I')
+
+# Значения столбца joined_at: поля нет в данных участника / поле хранится в профиле
+_NO_JOINED_AT = -2 ** 63
+_JOINED_AT_IN_PROFILE = -2 ** 63 + 1
+_EPOCH = datetime(1970, 1, 1)
+
+_MAX_TICKETS = 0xFFFFFFFF
+_NATIVE_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+Buffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+def _column_bytes(values: List[int], typecode: str) -> bytes:
+    column = array(typecode, values)
+    if not _NATIVE_LITTLE_ENDIAN:
+        column.byteswap()
+    return column.tobytes()
+
+
+def _column_values(raw: bytes, typecode: str) -> List[int]:
+    column = array(typecode)
+    column.frombytes(raw)
+    if not _NATIVE_LITTLE_ENDIAN:
+        column.byteswap()
+    return column.tolist()
+
+
+def _joined_at_value(value: Any) -> int:
+    """Значение столбца joined_at для поля joined_at профиля."""
+    if not isinstance(value, str):
+        return _JOINED_AT_IN_PROFILE
+    try:
+        joined_at = datetime.fromisoformat(value)
+    except ValueError:
+        return _JOINED_AT_IN_PROFILE
+    if joined_at.tzinfo is not None or joined_at.isoformat() != value:
+        return _JOINED_AT_IN_PROFILE
+    return (joined_at - _EPOCH) // timedelta(microseconds=1)
+
+
+def _encode_section(users: Dict[str, Dict[str, Any]]):
+    rows = []
+    for user_id, profile in users.items():
+        numeric_id = int(user_id)
+        if str(numeric_id) != user_id:
+            raise ValueError(f"ID участника {user_id!r} нельзя сохранить без потерь")
+        rows.append((numeric_id, profile))
+    rows.sort(key=lambda row: row[0])
+
+    joined = []
+    tickets = []
+    profiles = []
+    for numeric_id, profile in rows:
+        value = profile.get("tickets", 0)
+        if "tickets" in profile and (type(value) is not int or not 1 <= value <= _MAX_TICKETS):
+            raise ValueError(f"Количество билетов участника {numeric_id} нельзя сохранить без потерь: {value!r}")
+        tickets.append(value)
+
+        joined_at = _joined_at_value(profile["joined_at"]) if "joined_at" in profile else _NO_JOINED_AT
+        joined.append(joined_at)
+        columns = ("tickets", "joined_at") if joined_at != _JOINED_AT_IN_PROFILE else ("tickets",)
+        profiles.append({key: field for key, field in profile.items() if key not in columns})
+
+    return (
+        _column_bytes([numeric_id for numeric_id, _ in rows], 'q'),
+        _column_bytes(joined, 'q'),
+        _column_bytes(tickets, 'I'),
+        json.dumps(profiles, ensure_ascii=False, separators=(',', ':')).encode('utf-8'),
+        len(rows)
+    )
+
+
+def encode(participants: Dict[str, Dict[str, Dict[str, Any]]]) -> bytes:
+    """
+    Кодирует участников канала (raffle_id -> user_id -> данные участника) в компактный формат.
+
+    Выбрасывает ValueError, если данные нельзя сохранить без потерь (нечисловой ID участника и т.п.).
+    """
+    names = [raffle_id.encode('utf-8') for raffle_id in participants]
+    sections = [_encode_section(users) for users in participants.values()]
+
+    directory_offset = _align(_HEADER.size)
+    names_offset = directory_offset + _ENTRY.size * len(names)
+    names_len = sum(len(name) for name in names)
+
+    entries = []
+    chunks = []
+    name_offset = names_offset
+    offset = _align(names_offset + names_len)
+    for name, (ids, joined, tickets, profiles, count) in zip(names, sections):
+        ids_offset = offset
+        joined_offset = ids_offset + len(ids)
+        tickets_offset = joined_offset + len(joined)
+        profiles_offset = _align(tickets_offset + len(tickets))
+        padding = b'\0' * (profiles_offset - tickets_offset - len(tickets))
+        section = ids + joined + tickets + padding + profiles
+
+        entries.append(_ENTRY.pack(
+            name_offset, len(name), count, ids_offset, joined_offset, tickets_offset, profiles_offset,
+            len(profiles), hashlib.sha256(section).digest()
+        ))
+        chunks.append(section + b'\0' * (_align(len(section)) - len(section)))
+        name_offset += len(name)
+        offset = _align(profiles_offset + len(profiles))
+
+    directory = b''.join(entries) + b''.join(names)
+    header = _HEADER.pack(
+        MAGIC, FORMAT_VERSION, 0, len(names), names_len, hashlib.sha256(directory).digest()
+    )
+    names_padding = b'\0' * (_align(names_offset + names_len) - names_offset - names_len)
+    return (
+        header + b'\0' * (directory_offset - _HEADER.size)
+        + directory + names_padding + b''.join(chunks)
+    )
+
+
+class ParticipantsSnapshot:
+    """
+    Участники канала в компактном формате поверх байтов или отображенного в память файла.
+
+    При открытии разбираются только заголовок и каталог (их контрольная сумма проверяется сразу).
+    Запросы к столбцам ID и joined_at читают буфер напрямую, профили разбираются только в raffle_participants().
+    Выбрасывает ValueError, если буфер не является файлом компактного формата или поврежден.
+    """
+
+    def __init__(self, buffer: Buffer):
+        self._buffer = buffer
+        if len(buffer) < _HEADER.size:
+            raise ValueError("файл участников слишком короткий")
+
+        magic, version, _, raffle_count, names_len, checksum = _HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("не файл участников компактного формата")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"неподдерживаемая версия формата участников: {version}")
+
+        directory_offset = _align(_HEADER.size)
+        directory_end = directory_offset + _ENTRY.size * raffle_count + names_len
+        if directory_end > len(buffer) or hashlib.sha256(buffer[directory_offset:directory_end]).digest() != checksum:
+            raise ValueError("каталог файла участников поврежден")
+
+        self._entries: Dict[str, tuple] = {}
+        for index in range(raffle_count):
+            entry = _ENTRY.unpack_from(buffer, directory_offset + index * _ENTRY.size)
+            (name_offset, name_len, count, ids_offset, joined_offset,
+             tickets_offset, profiles_offset, profiles_len, _) = entry
+            if (ids_offset + _ID.size * count > joined_offset
+                    or joined_offset + _JOINED_AT.size * count > tickets_offset
+                    or tickets_offset + _TICKETS.size * count > profiles_offset
+                    or profiles_offset + profiles_len > len(buffer)):
+                raise ValueError("каталог файла участников поврежден")
+            raffle_id = bytes(buffer[name_offset:name_offset + name_len]).decode('utf-8')
+            self._entries[raffle_id] = entry
+
+    @classmethod
+    def open(cls, path: str) -> "ParticipantsSnapshot":
+        """Открывает файл участников через mmap (только чтение)."""
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls(buffer)
+        except ValueError:
+            buffer.close()
+            raise
+
+    def close(self) -> None:
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+
+    def __enter__(self) -> "ParticipantsSnapshot":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __contains__(self, raffle_id: str) -> bool:
+        return raffle_id in self._entries
+
+    def count(self, raffle_id: str) -> int:
+        """Количество участников розыгрыша (0, если розыгрыша нет в файле)."""
+        entry = self._entries.get(raffle_id)
+        return entry[2] if entry else 0
+
+    def _user_id_at(self, ids_offset: int, index: int) -> int:
+        return _ID.unpack_from(self._buffer, ids_offset + index * _ID.size)[0]
+
+    def _lower_bound(self, ids_offset: int, count: int, user_id: int) -> int:
+        """Двоичный поиск в столбце ID без копирования столбца: индекс первого ID >= user_id."""
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._user_id_at(ids_offset, middle) < user_id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def contains(self, raffle_id: str, user_id: int) -> bool:
+        """Проверяет, участвует ли пользователь в розыгрыше, за O(log n)."""
+        entry = self._entries.get(raffle_id)
+        if entry is None:
+            return False
+        count, ids_offset = entry[2], entry[3]
+        index = self._lower_bound(ids_offset, count, user_id)
+        return index < count and self._user_id_at(ids_offset, index) == user_id
+
+    def iter_user_ids(self, raffle_id: str, after: Optional[int] = None) -> Iterator[int]:
+        """Выдает ID участников розыгрыша по возрастанию, начиная после after, читая столбец ID по одному."""
+        entry = self._entries.get(raffle_id)
+        if entry is None:
+            return
+        count, ids_offset = entry[2], entry[3]
+        start = self._lower_bound(ids_offset, count, after + 1) if after is not None else 0
+        for index in range(start, count):
+            yield self._user_id_at(ids_offset, index)
+
+    def user_ids(self, raffle_id: str) -> List[int]:
+        """ID участников розыгрыша по возрастанию."""
+        entry = self._entries.get(raffle_id)
+        if entry is None:
+            return []
+        count, ids_offset = entry[2], entry[3]
+        return _column_values(self._buffer[ids_offset:ids_offset + _ID.size * count], 'q')
+
+    def joined_at_values(self, raffle_id: str) -> Iterator[Optional[datetime]]:
+        """
+        Выдает время регистрации участников розыгрыша (None, если оно не задано) по столбцу joined_at.
+
+        Профили разбираются, только если время регистрации кого-то из участников хранится в профиле.
+        """
+        entry = self._entries.get(raffle_id)
+        if entry is None:
+            return
+        count, joined_offset = entry[2], entry[4]
+        profiles = None
+        for index in range(count):
+            value = _JOINED_AT.unpack_from(self._buffer, joined_offset + index * _JOINED_AT.size)[0]
+            if value == _NO_JOINED_AT:
+                yield None
+            elif value == _JOINED_AT_IN_PROFILE:
+                if profiles is None:
+                    profiles = self._profiles(entry)
+                try:
+                    yield datetime.fromisoformat(profiles[index]["joined_at"])
+                except (TypeError, ValueError):
+                    yield None
+            else:
+                yield _EPOCH + timedelta(microseconds=value)
+
+    def _profiles(self, entry: tuple) -> List[Dict[str, Any]]:
+        profiles_offset, profiles_len = entry[6], entry[7]
+        return json.loads(bytes(self._buffer[profiles_offset:profiles_offset + profiles_len]).decode('utf-8'))
+
+    def raffle_participants(self, raffle_id: str) -> Optional[Dict[str, Dict[str, Any]]]:
+        """Участники розыгрыша в формате JSON файлов (user_id -> данные) или None, если розыгрыша нет."""
+        entry = self._entries.get(raffle_id)
+        if entry is None:
+            return None
+        _, _, count, ids_offset, joined_offset, tickets_offset, profiles_offset, profiles_len, checksum = entry
+
+        section = self._buffer[ids_offset:profiles_offset + profiles_len]
+        if hashlib.sha256(section).digest() != checksum:
+            raise ValueError(f"данные участников розыгрыша {raffle_id} повреждены")
+
+        user_ids = _column_values(section[:_ID.size * count], 'q')
+        start = joined_offset - ids_offset
+        joined = _column_values(section[start:start + _JOINED_AT.size * count], 'q')
+        start = tickets_offset - ids_offset
+        tickets = _column_values(section[start:start + _TICKETS.size * count], 'I')
+        profiles = json.loads(section[profiles_offset - ids_offset:].decode('utf-8'))
+        if len(profiles) != count:
+            raise ValueError(f"данные участников розыгрыша {raffle_id} повреждены")
+
+        users = {}
+        for user_id, joined_at, value, profile in zip(user_ids, joined, tickets, profiles):
+            if joined_at not in (_NO_JOINED_AT, _JOINED_AT_IN_PROFILE):
+                profile["joined_at"] = (_EPOCH + timedelta(microseconds=joined_at)).isoformat()
+            if value:
+                profile["tickets"] = value
+            users[str(user_id)] = profile
+        return users
+
+    def to_dict(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """Все участники канала в формате JSON файлов (с проверкой контрольных сумм всех секций)."""
+        return {raffle_id: self.raffle_participants(raffle_id) for raffle_id in self._entries}
+
+
+def decode(raw: Buffer) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """Декодирует файл компактного формата целиком. Выбрасывает ValueError, если он поврежден."""
+    return ParticipantsSnapshot(raw).to_dict()
+
+
+def _load_json_participants(path: str) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    # Снимок с контрольной суммой из хранилища бота: {"format": 1, "sha256": "...", "data": {...}}
+    if set(data) == {"format", "sha256", "data"}:
+        return data["data"]
+    return data
+
+
+def main() -> None:
+    """Конвертация файла участников между JSON и компактным форматом."""
+    if len(sys.argv) != 4 or sys.argv[1] not in ('to-compact', 'to-json'):
+        print("Использование: python compact.py to-compact|to-json <исходный файл> <новый файл>")
+        sys.exit(2)
+
+    command, source, target = sys.argv[1:]
+    if command == 'to-compact':
+        raw = encode(_load_json_participants(source))
+        with open(target, 'wb') as f:
+            f.write(raw)
+    else:
+        with ParticipantsSnapshot.open(source) as snapshot:
+            data = snapshot.to_dict()
+        with open(target, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+
+    print(f"Готово: {target}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,167 +1,1002 @@
+import bisect
+import gzip
+import hashlib
 import json
+import logging
 import os
-from datetime import datetime
-from typing import List, Dict, Optional, Any
+import shutil
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from weakref import WeakKeyDictionary
 
-# Путь к файлам базы данных
-RAFFLES_FILE = 'data/raffles.json'
-PARTICIPANTS_FILE = 'data/participants.json'
+import compact
+from join_stats import JoinStats
 
-# Создание директории для данных, если она не существует
-os.makedirs('data', exist_ok=True)
+logger = logging.getLogger(__name__)
 
-# Структура базы данных для розыгрышей
+# Корневая директория с данными
+DATA_DIR = 'data'
+
+# Путь к файлу SQLite по умолчанию для режима общего хранилища
+SQLITE_FILE = os.path.join(DATA_DIR, 'raffle-bot.sqlite3')
+
+# Файлы старого формата (один канал, ID розыгрыша = ID сообщения). Ищутся в директории хранилища
+# (legacy_dir): в директории JSON хранилища или рядом с файлом SQLite; у хранилища в памяти их нет
+LEGACY_RAFFLES_FILENAME = 'raffles.json'
+LEGACY_PARTICIPANTS_FILENAME = 'participants.json'
+
+RAFFLES_FILENAME = 'raffles.json'
+PARTICIPANTS_FILENAME = 'participants.bin'
+
+# Участники в JSON до перехода на компактный формат (см. convert_participants_storage)
+PARTICIPANTS_JSON_FILENAME = 'participants.json'
+
+# Время, на которое администратор захватывает розыгрыш для определения победителей
+DRAW_LOCK_TTL = timedelta(minutes=10)
+
+# Сколько дополнительных билетов получает участник за каждого приглашенного участника
+REFERRAL_BONUS_TICKETS = 1
+
+# Статусы рассылок и время, на которое процесс бота захватывает рассылку для выполнения
+BROADCAST_RUNNING = 'running'
+BROADCAST_DONE = 'done'
+BROADCAST_CANCELLED = 'cancelled'
+BROADCAST_LEASE_TTL = timedelta(minutes=2)
+
+# Сколько архивов завершенных розыгрышей держать в памяти
+ARCHIVE_CACHE_SIZE = 32
+
+# Сколько последних заархивированных розыгрышей помнить для списков завершенных розыгрышей
+RECENT_ARCHIVED_SIZE = 20
+
+# Сигнатура gzip, по которой сжатые документы отличаются от обычных
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Хранилище данных выбирается явно через init_storage() при запуске бота. Импорт модуля ничего не создает:
+# если init_storage() не вызывался, при первом обращении открываются JSON файлы в директории data/.
+# Хранилище, выбранное в задаче asyncio, видно только ей и задачам, которые она создает,
+# поэтому в одном процессе можно запустить несколько изолированных экземпляров бота.
+_default_storage = None
+_current_storage: ContextVar = ContextVar('storage', default=None)
+_storage_initialized = False
+
+# Кэш недавно прочитанных архивов хранилища: raffle_id -> {"raffle": ..., "participants": ...}
+_archive_caches: "WeakKeyDictionary[Any, OrderedDict[str, Dict[str, Any]]]" = WeakKeyDictionary()
+
+# Структура базы данных для розыгрышей (channels/<chat_id>/raffles.json)
 # {
-#     "raffle_id": {
+#     "<chat_id>_<message_id>": {
+#         "chat_id": -1001234567890,
+#         "channel": "@channel",
 #         "message_id": 123,
 #         "text": "Текст поста",
+#         "photo": "file_id" или null (фото поста),
+#         "is_caption": true, если текст поста - подпись к фото,
 #         "created_at": "2023-09-01T12:00:00",
 #         "end_date": "2023-09-10T12:00:00",
 #         "is_active": true,
 #         "winners_count": 1,
-#         "winners": [null] или [123, 456] (ID победителей)
+#         "winners": [null] или [123, 456] (ID победителей),
+#         "draw_lock": {"owner": "...", "expires_at": "..."} (пока идет определение победителей),
+#         "draw": {"seed": "...", "snapshot_hash": "...", "candidates": [...], ...} (протокол розыгрыша)
 #     }
 # }
 
-# Структура базы данных для участников
+# Структура базы данных для участников (channels/<chat_id>/participants.bin - компактный формат compact.py,
+# ниже - его представление в JSON)
 # {
-#     "raffle_id": {
+#     "<chat_id>_<message_id>": {
 #         "user_id": {
 #             "username": "username",
 #             "first_name": "First",
 #             "last_name": "Last",
-#             "joined_at": "2023-09-01T12:30:00"
+#             "joined_at": "2023-09-01T12:30:00",
+#             "tickets": 1 (количество билетов - шансов на победу),
+#             "referred_by": 123 (необязательно, ID пригласившего участника)
 #         }
 #     }
 # }
 
-def _load_json(file_path: str) -> Dict:
-    """Загружает данные из JSON файла."""
-    if not os.path.exists(file_path):
-        with open(file_path, 'w') as f:
-            json.dump({}, f)
+# В channels/<chat_id>/ хранятся только активные розыгрыши. Завершенные розыгрыши
+# переносятся в сжатый архив archive/<chat_id>/<raffle_id>.json.gz:
+# {"raffle": {...данные розыгрыша...}, "participants": {"user_id": {...}}}
+# Последние заархивированные розыгрыши всех каналов (не больше RECENT_ARCHIVED_SIZE, новые первыми)
+# хранятся в archive/recent.json: {"raffles": [[raffle_id, archived_at], ...]}
+# Задания рассылок хранятся в broadcasts/<job_id>.json:
+# {"raffle_id": ..., "audience": "participants" | "winners", "text": ..., "status": "running" | "done" | "cancelled",
+#  "owner": процесс-исполнитель, "lease_until": ..., "cursor": последний обработанный user_id,
+#  "in_flight": [user_id пакета, который отправляется сейчас], "sent": 0, "failed": {"user_id": "ошибка"},
+#  "unknown": [user_id, доставка которым не подтверждена из-за сбоя]}
+# Список незавершенных рассылок хранится в broadcasts/index.json: {"running": [job_id, ...]},
+# чтобы поиск брошенных рассылок не читал задания всех когда-либо созданных рассылок
+# Снимок участников, по которому определялись победители, хранится в draws/<chat_id>/<raffle_id>.json.gz:
+# {"participants": [[user_id, билеты], ...]}
+# Статистика регистраций по времени хранится в stats/<chat_id>/<raffle_id>.json (см. join_stats.py):
+# {"total": ..., "first_join": ..., "last_join": ..., "hours": {"YYYY-MM-DDTHH": количество},
+#  "recent_minutes": {"YYYY-MM-DDTHH:MM": количество}, "peak_minutes": [["YYYY-MM-DDTHH:MM", количество], ...]}
+
+def _open_storage(backend: str, path: Optional[str]):
+    # Модуль выбранного хранилища импортируется только при подключении
+    if backend == 'json':
+        from storage import FileStorage
+        return FileStorage(path or DATA_DIR)
+    if backend == 'sqlite':
+        from storage import SqliteStorage
+        return SqliteStorage(path or SQLITE_FILE)
+    if backend == 'memory':
+        from storage import MemoryStorage
+        return MemoryStorage()
+    raise ValueError(f"Неизвестный тип хранилища: {backend}")
+
+def init_storage(path: Optional[str] = None, backend: str = 'json') -> None:
+    """
+    Подключает хранилище данных в текущем контексте (задаче asyncio и задачах, которые она создаст).
+
+    backend="json" - файлы в директории path (по умолчанию data/), только для одного процесса.
+    backend="sqlite" - файл SQLite path (по умолчанию data/raffle-bot.sqlite3),
+    который могут одновременно использовать несколько процессов бота.
+    backend="memory" - данные в памяти процесса (тесты, бенчмарки), path не используется.
+    """
+    global _storage_initialized
+    _current_storage.set(_open_storage(backend, path))
+    _storage_initialized = True
+
+def _get_storage():
+    """Возвращает хранилище текущего контекста, при необходимости открывая хранилище по умолчанию."""
+    storage = _current_storage.get()
+    if storage is not None:
+        return storage
+
+    # Если хранилище уже выбрано в другом контексте, молча подставить чужое или хранилище по умолчанию
+    # означало бы смешать данные изолированных экземпляров бота
+    if _storage_initialized:
+        raise RuntimeError("Хранилище не подключено в этом контексте: вызовите init_storage()")
+
+    global _default_storage
+    if _default_storage is None:
+        _default_storage = _open_storage('json', None)
+    return _default_storage
+
+def make_raffle_id(chat_id: int, message_id: int) -> str:
+    """Формирует ID розыгрыша из ID канала и ID сообщения."""
+    return f"{chat_id}_{message_id}"
+
+def parse_raffle_id(raffle_id: str) -> Tuple[int, int]:
+    """Разбирает ID розыгрыша на ID канала и ID сообщения."""
+    chat_id, message_id = raffle_id.rsplit('_', 1)
+    return int(chat_id), int(message_id)
+
+def _raffles_key(chat_id: int) -> str:
+    return f"channels/{chat_id}/{RAFFLES_FILENAME}"
+
+def _participants_key(chat_id: int) -> str:
+    return f"channels/{chat_id}/{PARTICIPANTS_FILENAME}"
+
+def _participants_json_key(chat_id: int) -> str:
+    return f"channels/{chat_id}/{PARTICIPANTS_JSON_FILENAME}"
+
+def _chat_id_of(raffle_id: str) -> Optional[int]:
+    """Возвращает ID канала розыгрыша или None, если ID розыгрыша некорректен."""
+    try:
+        return parse_raffle_id(raffle_id)[0]
+    except ValueError:
+        return None
+
+def get_channel_ids() -> List[int]:
+    """Возвращает ID всех каналов, для которых есть сохраненные данные."""
+    channel_ids = set()
+    for key in _get_storage().list_keys('channels/'):
+        try:
+            channel_ids.add(int(key.split('/')[1]))
+        except (IndexError, ValueError):
+            continue
+    return sorted(channel_ids)
+
+class StorageCorruptedError(Exception):
+    """Документ хранилища поврежден, и восстановить его из предыдущего снимка не удалось."""
+
+def _snapshot_prefix(checksum: str) -> bytes:
+    return b'{"format":1,"sha256":"' + checksum.encode('ascii') + b'","data":'
+
+# Длина заголовка снимка фиксирована (контрольная сумма SHA-256 всегда 64 символа)
+_SNAPSHOT_PREFIX_LEN = len(_snapshot_prefix('0' * 64))
+
+def _encode_snapshot(data: Dict) -> bytes:
+    """
+    Кодирует документ в снимок с контрольной суммой.
+
+    Снимок - это валидный JSON {"format":1,"sha256":"...","data":...}, где sha256 считается
+    по байтам поля data. Заголовок имеет фиксированную длину, поэтому при чтении
+    контрольная сумма проверяется без повторной сериализации данных.
+    """
+    body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return _snapshot_prefix(hashlib.sha256(body).hexdigest()) + body + b'}'
+
+def _decode_snapshot(raw: bytes) -> Dict:
+    """Декодирует снимок, проверяя контрольную сумму. Файлы старого формата (обычный JSON) читаются как есть."""
+    if not raw.startswith(b'{"format":1,"sha256":"'):
+        return json.loads(raw.decode('utf-8'))
+
+    header, body = raw[:_SNAPSHOT_PREFIX_LEN], raw[_SNAPSHOT_PREFIX_LEN:-1]
+    checksum = header[len(b'{"format":1,"sha256":"'):-len(b'","data":')].decode('ascii')
+    if not raw.endswith(b'}') or hashlib.sha256(body).hexdigest() != checksum:
+        raise ValueError("контрольная сумма не совпадает")
+    return json.loads(body.decode('utf-8'))
+
+def _decode_document(raw: bytes) -> Dict:
+    """Декодирует документ, при необходимости распаковывая gzip (архив завершенных розыгрышей)."""
+    if raw.startswith(GZIP_MAGIC):
+        try:
+            raw = gzip.decompress(raw)
+        except (OSError, EOFError) as e:
+            raise ValueError(f"архив поврежден: {e}")
+    return _decode_snapshot(raw)
+
+def _load_json(key: str, decode: Callable[[bytes], Dict] = _decode_document) -> Dict:
+    """Загружает JSON документ из хранилища (или документ другого формата, если указан decode)."""
+    raw = _get_storage().read(key)
+    if raw is None:
         return {}
-    
-    with open(file_path, 'r', encoding='utf-8') as f:
+
+    try:
+        return decode(raw)
+    except ValueError as e:
+        # json.JSONDecodeError и UnicodeDecodeError - подклассы ValueError
+        logger.error(f"Документ {key} поврежден ({e}), восстанавливаем из предыдущего снимка")
+
+    # Если снимок тоже поврежден, выбрасываем исключение, а не возвращаем пустые данные:
+    # следующая запись не должна затереть то, что еще можно спасти вручную
+    backup = _get_storage().read_backup(key)
+    if backup is not None:
         try:
-            return json.load(f)
-        except json.JSONDecodeError:
-            return {}
+            return decode(backup)
+        except ValueError as e:
+            logger.error(f"Предыдущий снимок документа {key} тоже поврежден: {e}")
+    raise StorageCorruptedError(f"Документ {key} поврежден и не может быть восстановлен")
+
+def _save_json(key: str, data: Dict, compress: bool = False) -> None:
+    """Сохраняет JSON документ в хранилище в виде снимка с контрольной суммой (при compress=True - сжатым gzip)."""
+    raw = _encode_snapshot(data)
+    if compress:
+        raw = gzip.compress(raw, compresslevel=6)
+    _get_storage().write(key, raw)
+
+def _load_participants(chat_id: int) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """Загружает участников канала целиком (для изменения). Данные старого JSON формата читаются до первой записи."""
+    participants = _load_json(_participants_key(chat_id), decode=compact.decode)
+    if not participants:
+        participants = _load_json(_participants_json_key(chat_id))
+    return participants
+
+def _save_participants(chat_id: int, participants: Dict[str, Dict[str, Dict[str, Any]]]) -> None:
+    """Сохраняет участников канала в компактном формате."""
+    _get_storage().write(_participants_key(chat_id), compact.encode(participants))
+    _get_storage().delete(_participants_json_key(chat_id))
+
+@contextmanager
+def _open_participants(chat_id: int) -> Iterator[compact.ParticipantsSnapshot]:
+    """
+    Открывает участников канала только для чтения, не разбирая профили участников.
+
+    Файловое хранилище отображает файл в память (mmap), поэтому проверка участия и подсчет участников
+    не зависят от объема профилей. Если файла еще нет или он поврежден, участники загружаются целиком
+    через _load_participants (с восстановлением из предыдущего снимка).
+    """
+    raw = _get_storage().read_mapped(_participants_key(chat_id))
+    snapshot = None
+    if raw:
+        try:
+            snapshot = compact.ParticipantsSnapshot(raw)
+        except ValueError as e:
+            logger.error(f"Участники канала {chat_id} повреждены ({e}), восстанавливаем из предыдущего снимка")
+            if hasattr(raw, 'close'):
+                raw.close()
+    if snapshot is None:
+        snapshot = compact.ParticipantsSnapshot(compact.encode(_load_participants(chat_id)))
+
+    try:
+        yield snapshot
+    finally:
+        snapshot.close()
+
+def convert_participants_storage() -> int:
+    """
+    Переводит участников всех каналов из JSON в компактный формат без потерь.
+
+    Возвращает количество конвертированных каналов.
+    """
+    converted = 0
+    for channel_id in get_channel_ids():
+        with _get_storage().transaction():
+            if _get_storage().read(_participants_json_key(channel_id)) is None:
+                continue
+            _save_participants(channel_id, _load_participants(channel_id))
+            converted += 1
+    return converted
+
+def load_document(key: str) -> Dict:
+    """Загружает произвольный документ хранилища (например, состояние бота)."""
+    return _load_json(key)
+
+def save_document(key: str, data: Dict) -> None:
+    """Сохраняет произвольный документ хранилища."""
+    with _get_storage().transaction():
+        _save_json(key, data)
+
+def delete_document(key: str) -> None:
+    """Удаляет документ хранилища."""
+    with _get_storage().transaction():
+        _get_storage().delete(key)
+
+def list_documents(prefix: str) -> List[str]:
+    """Возвращает ключи документов, начинающиеся с prefix."""
+    return _get_storage().list_keys(prefix)
+
+def recover_storage() -> int:
+    """Быстрое восстановление хранилища после сбоя: удаляет следы незавершенных записей."""
+    return _get_storage().recover()
+
+def create_raffle(chat_id: int, message_id: int, text: str, end_date: str,
+                  winners_count: int = 1, channel: Optional[str] = None, photo: Optional[str] = None) -> str:
+    """
+    Создает новый розыгрыш в канале и возвращает его ID.
+
+    Вместе с розыгрышем сохраняются данные поста (file_id фото и признак того, что текст - подпись к фото),
+    чтобы пост можно было обновить без исходного сообщения на руках.
+    """
+    raffle_id = make_raffle_id(chat_id, message_id)
+
+    with _get_storage().transaction():
+        raffles = _load_json(_raffles_key(chat_id))
+        raffles[raffle_id] = {
+            "chat_id": chat_id,
+            "channel": channel,
+            "message_id": message_id,
+            "text": text,
+            "photo": photo,
+            "is_caption": photo is not None,
+            "created_at": datetime.now().isoformat(),
+            "end_date": end_date,
+            "is_active": True,
+            "winners_count": winners_count,
+            "winners": [None] * winners_count  # Список с None для каждого победителя
+        }
+        _save_json(_raffles_key(chat_id), raffles)
+
+        # Создаем пустой список участников для этого розыгрыша
+        participants = _load_participants(chat_id)
+        participants.setdefault(raffle_id, {})
+        _save_participants(chat_id, participants)
 
-def _save_json(file_path: str, data: Dict) -> None:
-    """Сохраняет данные в JSON файл."""
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-def create_raffle(message_id: int, text: str, end_date: str, winners_count: int = 1) -> str:
-    """Создает новый розыгрыш и возвращает его ID."""
-    raffles = _load_json(RAFFLES_FILE)
-    
-    raffle_id = str(message_id)
-    raffles[raffle_id] = {
-        "message_id": message_id,
-        "text": text,
-        "created_at": datetime.now().isoformat(),
-        "end_date": end_date,
-        "is_active": True,
-        "winners_count": winners_count,
-        "winners": [None] * winners_count  # Список с None для каждого победителя
-    }
-    
-    _save_json(RAFFLES_FILE, raffles)
-    
-    # Создаем пустой список участников для этого розыгрыша
-    participants = _load_json(PARTICIPANTS_FILE)
-    participants[raffle_id] = {}
-    _save_json(PARTICIPANTS_FILE, participants)
-    
     return raffle_id
 
-def add_participant(raffle_id: str, user_id: int, username: str, first_name: str, last_name: str) -> bool:
-    """Добавляет участника в розыгрыш. Возвращает True если участник добавлен, False если уже существует."""
-    participants = _load_json(PARTICIPANTS_FILE)
-    
-    if raffle_id not in participants:
-        participants[raffle_id] = {}
-    
-    user_id_str = str(user_id)
-    
-    # Если пользователь уже участвует, не добавляем его снова
-    if user_id_str in participants[raffle_id]:
+def add_participant(raffle_id: str, user_id: int, username: str, first_name: str, last_name: str,
+                    referred_by: Optional[int] = None) -> bool:
+    """Добавляет участника в активный розыгрыш. Возвращает True если участник добавлен, False если уже существует."""
+    chat_id = _chat_id_of(raffle_id)
+    if chat_id is None:
         return False
-    
-    participants[raffle_id][user_id_str] = {
-        "username": username,
-        "first_name": first_name,
-        "last_name": last_name,
-        "joined_at": datetime.now().isoformat()
-    }
-    
-    _save_json(PARTICIPANTS_FILE, participants)
+
+    with _get_storage().transaction():
+        # Розыгрыш мог завершиться, пока проверялась подписка: запоздавшее нажатие создало бы в активных данных
+        # пустую секцию заархивированного розыгрыша, которая скрыла бы его архив
+        raffle = _load_json(_raffles_key(chat_id)).get(raffle_id)
+        if not raffle or not raffle.get('is_active', False):
+            return False
+
+        stats_data = _load_json(_join_stats_key(raffle_id))
+
+        # Повторное нажатие (в том числе доставленное другому процессу бота) отсеивается по столбцу ID,
+        # без загрузки всех участников канала
+        with _open_participants(chat_id) as snapshot:
+            if snapshot.contains(raffle_id, user_id):
+                return False
+            if stats_data:
+                stats = JoinStats(stats_data)
+            else:
+                # Розыгрыш создан до появления статистики: строим ее по столбцу времени регистрации
+                stats = JoinStats.backfill(snapshot.joined_at_values(raffle_id))
+
+        participants = _load_participants(chat_id)
+
+        if raffle_id not in participants:
+            participants[raffle_id] = {}
+
+        user_id_str = str(user_id)
+
+        # Если пользователь уже участвует, не добавляем его снова
+        if user_id_str in participants[raffle_id]:
+            return False
+
+        joined_at = datetime.now()
+        participants[raffle_id][user_id_str] = {
+            "username": username,
+            "first_name": first_name,
+            "last_name": last_name,
+            "joined_at": joined_at.isoformat(),
+            "tickets": 1
+        }
+
+        # Пригласивший получает дополнительные билеты, только если сам участвует в розыгрыше
+        referrer = participants[raffle_id].get(str(referred_by)) if referred_by != user_id else None
+        if referrer is not None:
+            participants[raffle_id][user_id_str]["referred_by"] = referred_by
+            referrer["tickets"] = referrer.get("tickets", 1) + REFERRAL_BONUS_TICKETS
+
+        _save_participants(chat_id, participants)
+
+        # Счетчики регистраций по времени обновляются в той же транзакции
+        stats.record(joined_at)
+        _save_json(_join_stats_key(raffle_id), stats.to_dict())
     return True
 
+def _join_stats_key(raffle_id: str) -> str:
+    return f"stats/{_chat_id_of(raffle_id)}/{raffle_id}.json"
+
+def get_join_stats(raffle_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Возвращает статистику регистраций розыгрыша по времени или None, если розыгрыша нет.
+
+    Счетчики обновляются при каждой регистрации, поэтому чтение не зависит от количества участников.
+    Для розыгрышей без статистики (созданных до ее появления) она один раз строится по сохраненным участникам.
+    """
+    if _chat_id_of(raffle_id) is None:
+        return None
+
+    stats_data = _load_json(_join_stats_key(raffle_id))
+    if stats_data:
+        return stats_data
+
+    with _get_storage().transaction():
+        stats_data = _load_json(_join_stats_key(raffle_id))
+        if stats_data:
+            return stats_data
+
+        # Время регистрации активного розыгрыша читается из столбца joined_at без разбора профилей
+        chat_id = _chat_id_of(raffle_id)
+        stats = None
+        with _open_participants(chat_id) as snapshot:
+            if raffle_id in snapshot:
+                stats = JoinStats.backfill(snapshot.joined_at_values(raffle_id))
+        if stats is None:
+            archived = _load_archive(raffle_id)
+            if not archived:
+                return None
+            stats = JoinStats.backfill(p.get("joined_at") for p in archived["participants"].values())
+        stats_data = stats.to_dict()
+        _save_json(_join_stats_key(raffle_id), stats_data)
+    return stats_data
+
+def _get_raffle_participants(raffle_id: str) -> Optional[Dict[str, Dict[str, Any]]]:
+    """Возвращает участников розыгрыша (user_id -> данные) из активных данных или из архива."""
+    chat_id = _chat_id_of(raffle_id)
+    if chat_id is None:
+        return None
+
+    with _open_participants(chat_id) as snapshot:
+        if raffle_id in snapshot:
+            try:
+                return snapshot.raffle_participants(raffle_id)
+            except ValueError as e:
+                logger.error(f"Участники розыгрыша {raffle_id} повреждены ({e}), восстанавливаем из предыдущего снимка")
+                return _load_participants(chat_id).get(raffle_id)
+
+    archived = _load_archive(raffle_id)
+    return archived["participants"] if archived else None
+
 def get_participants(raffle_id: str) -> List[Dict[str, Any]]:
     """Возвращает список участников розыгрыша."""
-    participants = _load_json(PARTICIPANTS_FILE)
-    
-    if raffle_id not in participants:
+    participants = _get_raffle_participants(raffle_id)
+
+    if participants is None:
         return []
-    
+
     result = []
-    for user_id, user_data in participants[raffle_id].items():
+    for user_id, user_data in participants.items():
         user_info = user_data.copy()
         user_info['user_id'] = int(user_id)
         result.append(user_info)
-    
+
+    # Участники хранятся по возрастанию ID, список возвращается в порядке регистрации
+    result.sort(key=lambda participant: participant.get('joined_at', ''))
     return result
 
-def get_active_raffles() -> List[Dict[str, Any]]:
-    """Возвращает список активных розыгрышей."""
-    raffles = _load_json(RAFFLES_FILE)
-    
+def count_participants(raffle_id: str) -> int:
+    """Возвращает количество участников розыгрыша, не загружая их данные."""
+    chat_id = _chat_id_of(raffle_id)
+    if chat_id is None:
+        return 0
+
+    with _open_participants(chat_id) as snapshot:
+        if raffle_id in snapshot:
+            return snapshot.count(raffle_id)
+
+    archived = _load_archive(raffle_id)
+    return len(archived["participants"]) if archived else 0
+
+def add_tickets(raffle_id: str, user_id: int, tickets: int) -> Optional[int]:
+    """
+    Начисляет участнику активного розыгрыша дополнительные билеты.
+
+    Возвращает новое количество билетов или None, если розыгрыш не активен или пользователь в нем не участвует.
+    """
+    chat_id = _chat_id_of(raffle_id)
+    if chat_id is None:
+        return None
+
+    with _get_storage().transaction():
+        # Розыгрыш с победителями может еще не быть перенесен в архив
+        raffle = _load_json(_raffles_key(chat_id)).get(raffle_id)
+        if not raffle or not raffle.get('is_active', False):
+            return None
+
+        participants = _load_participants(chat_id)
+        participant = participants.get(raffle_id, {}).get(str(user_id))
+        if participant is None:
+            return None
+
+        participant["tickets"] = max(1, participant.get("tickets", 1) + tickets)
+        _save_participants(chat_id, participants)
+    return participant["tickets"]
+
+def get_active_raffles(chat_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Возвращает список активных розыгрышей канала или всех каналов, если канал не указан."""
+    channel_ids = [chat_id] if chat_id is not None else get_channel_ids()
+
     active_raffles = []
-    for raffle_id, raffle_data in raffles.items():
-        if raffle_data.get('is_active', False):
-            raffle_info = raffle_data.copy()
-            raffle_info['raffle_id'] = raffle_id
-            active_raffles.append(raffle_info)
-    
+    for channel_id in channel_ids:
+        raffles = _load_json(_raffles_key(channel_id))
+        for raffle_id, raffle_data in raffles.items():
+            if raffle_data.get('is_active', False):
+                raffle_info = raffle_data.copy()
+                raffle_info['raffle_id'] = raffle_id
+                active_raffles.append(raffle_info)
+
     return active_raffles
 
-def set_winners(raffle_id: str, winner_ids: List[int]) -> bool:
-    """Устанавливает победителей розыгрыша и закрывает его."""
-    raffles = _load_json(RAFFLES_FILE)
-    
-    if raffle_id not in raffles:
+def begin_draw(raffle_id: str, owner: str) -> bool:
+    """
+    Захватывает активный розыгрыш для определения победителей (compare-and-set).
+
+    Возвращает True, если захват удался: розыгрыш активен и не захвачен другим владельцем
+    (либо срок предыдущего захвата истек). Так победителей определяет ровно один процесс бота.
+    """
+    chat_id = _chat_id_of(raffle_id)
+    if chat_id is None:
         return False
-    
-    raffles[raffle_id]['winners'] = winner_ids
-    raffles[raffle_id]['is_active'] = False
-    
-    _save_json(RAFFLES_FILE, raffles)
+
+    with _get_storage().transaction():
+        raffles = _load_json(_raffles_key(chat_id))
+        raffle = raffles.get(raffle_id)
+        if not raffle or not raffle.get('is_active', False):
+            return False
+
+        now = datetime.now()
+        lock = raffle.get('draw_lock')
+        if lock and lock['owner'] != owner and datetime.fromisoformat(lock['expires_at']) > now:
+            return False
+
+        raffle['draw_lock'] = {"owner": owner, "expires_at": (now + DRAW_LOCK_TTL).isoformat()}
+        _save_json(_raffles_key(chat_id), raffles)
     return True
 
+def release_draw(raffle_id: str, owner: str) -> None:
+    """Снимает захват розыгрыша, если определить победителей не удалось."""
+    chat_id = _chat_id_of(raffle_id)
+    if chat_id is None:
+        return
+
+    with _get_storage().transaction():
+        raffles = _load_json(_raffles_key(chat_id))
+        raffle = raffles.get(raffle_id)
+        if raffle and raffle.get('draw_lock', {}).get('owner') == owner:
+            del raffle['draw_lock']
+            _save_json(_raffles_key(chat_id), raffles)
+
+def set_winners(raffle_id: str, winner_ids: List[int], owner: Optional[str] = None,
+                draw: Optional[Dict[str, Any]] = None, snapshot: Optional[List[Tuple[int, int]]] = None) -> bool:
+    """
+    Устанавливает победителей розыгрыша и закрывает его.
+
+    Победители записываются только в активный розыгрыш, поэтому повторный вызов вернет False.
+    Если указан owner, розыгрыш должен быть захвачен этим владельцем через begin_draw.
+    draw - протокол розыгрыша (draw_engine), сохраняется в записи розыгрыша;
+    snapshot - снимок участников (user_id, билеты), по которому проводился розыгрыш.
+    """
+    chat_id = _chat_id_of(raffle_id)
+    if chat_id is None:
+        return False
+
+    with _get_storage().transaction():
+        raffles = _load_json(_raffles_key(chat_id))
+
+        if raffle_id not in raffles:
+            return False
+
+        raffle = raffles[raffle_id]
+        if not raffle.get('is_active', False):
+            return False
+        if owner is not None and raffle.get('draw_lock', {}).get('owner') != owner:
+            return False
+
+        if snapshot is not None:
+            _save_json(_draw_snapshot_key(raffle_id), {"participants": snapshot}, compress=True)
+
+        raffle['winners'] = winner_ids
+        raffle['is_active'] = False
+        raffle.pop('draw_lock', None)
+        if draw is not None:
+            raffle['draw'] = draw
+
+        _save_json(_raffles_key(chat_id), raffles)
+    return True
+
+def _draw_snapshot_key(raffle_id: str) -> str:
+    return f"draws/{_chat_id_of(raffle_id)}/{raffle_id}.json.gz"
+
+def get_draw_audit(raffle_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Возвращает данные для независимой проверки розыгрыша:
+    {"transcript": протокол, "participants": [[user_id, билеты], ...]} или None, если протокола нет.
+    """
+    raffle = get_raffle(raffle_id)
+    if not raffle or not raffle.get('draw'):
+        return None
+
+    snapshot = _load_json(_draw_snapshot_key(raffle_id))
+    return {"transcript": raffle['draw'], "participants": snapshot.get("participants", [])}
+
 def get_raffle(raffle_id: str) -> Optional[Dict[str, Any]]:
     """Возвращает информацию о розыгрыше."""
-    raffles = _load_json(RAFFLES_FILE)
-    
-    if raffle_id not in raffles:
+    chat_id = _chat_id_of(raffle_id)
+    if chat_id is None:
         return None
-    
-    raffle_info = raffles[raffle_id].copy()
+
+    raffles = _load_json(_raffles_key(chat_id))
+
+    if raffle_id in raffles:
+        raffle_info = raffles[raffle_id].copy()
+    else:
+        # Завершенные розыгрыши хранятся в архиве и загружаются только по запросу
+        archived = _load_archive(raffle_id)
+        if not archived:
+            return None
+        raffle_info = archived["raffle"].copy()
+
     raffle_info['raffle_id'] = raffle_id
     return raffle_info
 
 def is_participant(raffle_id: str, user_id: int) -> bool:
-    """Проверяет, участвует ли пользователь в розыгрыше."""
-    participants = _load_json(PARTICIPANTS_FILE)
-    
-    if raffle_id not in participants:
+    """Проверяет, участвует ли пользователь в розыгрыше (двоичным поиском по столбцу ID, без загрузки данных)."""
+    chat_id = _chat_id_of(raffle_id)
+    if chat_id is None:
         return False
-    
-    return str(user_id) in participants[raffle_id]
+
+    with _open_participants(chat_id) as snapshot:
+        if raffle_id in snapshot:
+            return snapshot.contains(raffle_id, user_id)
+
+    archived = _load_archive(raffle_id)
+    return archived is not None and str(user_id) in archived["participants"]
+
+def _archive_key(raffle_id: str) -> str:
+    return f"archive/{_chat_id_of(raffle_id)}/{raffle_id}.json.gz"
+
+RECENT_ARCHIVED_KEY = 'archive/recent.json'
+
+def _load_archive(raffle_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Лениво загружает архив завершенного розыгрыша.
+
+    Архив после записи не меняется, поэтому последние прочитанные архивы кэшируются в памяти.
+    """
+    archive_cache = _archive_caches.setdefault(_get_storage(), OrderedDict())
+    if raffle_id in archive_cache:
+        archive_cache.move_to_end(raffle_id)
+        return archive_cache[raffle_id]
+
+    archived = _load_json(_archive_key(raffle_id))
+    if not archived:
+        return None
+
+    archive_cache[raffle_id] = archived
+    if len(archive_cache) > ARCHIVE_CACHE_SIZE:
+        archive_cache.popitem(last=False)
+    return archived
+
+def archive_raffle(raffle_id: str) -> bool:
+    """
+    Переносит завершенный розыгрыш и его участников в сжатый архив.
+
+    В активных данных канала остаются только активные розыгрыши, поэтому объем данных,
+    которые читаются и перезаписываются при каждом нажатии "Участвую", зависит только от них.
+    Возвращает True, если розыгрыш перенесен в архив.
+    """
+    chat_id = _chat_id_of(raffle_id)
+    if chat_id is None:
+        return False
+
+    with _get_storage().transaction():
+        raffles = _load_json(_raffles_key(chat_id))
+        raffle = raffles.get(raffle_id)
+        if not raffle or raffle.get('is_active', False):
+            return False
+
+        participants = _load_participants(chat_id)
+
+        # Сначала записываем архив: при сбое до удаления из активных данных розыгрыш
+        # останется в обоих местах и будет повторно заархивирован при следующем запуске
+        _save_json(
+            _archive_key(raffle_id),
+            {"raffle": raffle, "participants": participants.get(raffle_id, {})},
+            compress=True
+        )
+
+        del raffles[raffle_id]
+        participants.pop(raffle_id, None)
+        _save_json(_raffles_key(chat_id), raffles)
+        _save_participants(chat_id, participants)
+
+        recent = _load_json(RECENT_ARCHIVED_KEY).get("raffles", [])
+        recent = [[raffle_id, datetime.now().isoformat()]] + [entry for entry in recent if entry[0] != raffle_id]
+        _save_json(RECENT_ARCHIVED_KEY, {"raffles": recent[:RECENT_ARCHIVED_SIZE]})
+
+    return True
+
+def archive_finished_raffles() -> int:
+    """Переносит в архив все завершенные розыгрыши, оставшиеся в активных данных. Возвращает их количество."""
+    archived = 0
+    for channel_id in get_channel_ids():
+        raffles = _load_json(_raffles_key(channel_id))
+        for raffle_id, raffle_data in raffles.items():
+            if not raffle_data.get('is_active', False) and archive_raffle(raffle_id):
+                archived += 1
+    return archived
+
+def get_recently_archived_raffle_ids() -> List[str]:
+    """Возвращает ID последних заархивированных розыгрышей всех каналов, начиная с самых новых."""
+    return [raffle_id for raffle_id, _ in _load_json(RECENT_ARCHIVED_KEY).get("raffles", [])]
+
+def iter_recipient_ids(raffle_id: str, audience: str = 'participants', after: Optional[int] = None) -> Iterator[int]:
+    """
+    Выдает ID получателей рассылки по розыгрышу в порядке возрастания, начиная после after.
+
+    audience="participants" - все участники, audience="winners" - только победители.
+    Порядок по ID стабилен, поэтому рассылку можно продолжить с последнего обработанного получателя.
+    """
+    if audience == 'winners':
+        raffle = get_raffle(raffle_id) or {}
+        recipient_ids = sorted(winner for winner in raffle.get('winners', []) if winner is not None)
+    else:
+        chat_id = _chat_id_of(raffle_id)
+        if chat_id is None:
+            return
+        # Участники активного розыгрыша читаются из столбца ID по одному, начиная с курсора.
+        # Снимок остается открытым до конца рассылки: участники, добавленные после ее запуска, не получат сообщение
+        with _open_participants(chat_id) as snapshot:
+            if raffle_id in snapshot:
+                yield from snapshot.iter_user_ids(raffle_id, after)
+                return
+        archived = _load_archive(raffle_id)
+        recipient_ids = sorted(int(user_id) for user_id in archived["participants"]) if archived else []
+
+    start = bisect.bisect_right(recipient_ids, after) if after is not None else 0
+    for index in range(start, len(recipient_ids)):
+        yield recipient_ids[index]
+
+def _broadcast_key(job_id: str) -> str:
+    return f"broadcasts/{job_id}.json"
+
+BROADCAST_INDEX_KEY = 'broadcasts/index.json'
+
+def _set_broadcast_running(job_id: str, running: bool) -> None:
+    """Добавляет рассылку в список незавершенных или удаляет из него. Вызывается внутри транзакции."""
+    index = _load_json(BROADCAST_INDEX_KEY)
+    if not index:
+        index = {"running": _scan_unfinished_broadcast_ids()}
+    job_ids = [other for other in index["running"] if other != job_id]
+    if running:
+        job_ids.append(job_id)
+    index["running"] = job_ids
+    _save_json(BROADCAST_INDEX_KEY, index)
+
+def _scan_unfinished_broadcast_ids() -> List[str]:
+    """Ищет незавершенные рассылки перебором всех заданий (когда списка незавершенных рассылок еще нет)."""
+    job_ids = []
+    for key in _get_storage().list_keys('broadcasts/'):
+        if key == BROADCAST_INDEX_KEY:
+            continue
+        job = _load_json(key)
+        if job.get('status') == BROADCAST_RUNNING:
+            job_ids.append(job['job_id'])
+    return job_ids
+
+def create_broadcast(raffle_id: str, audience: str, text: str, created_by: int) -> str:
+    """Создает задание рассылки и возвращает его ID."""
+    job_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    with _get_storage().transaction():
+        _save_json(_broadcast_key(job_id), {
+            "job_id": job_id,
+            "raffle_id": raffle_id,
+            "audience": audience,
+            "text": text,
+            "created_by": created_by,
+            "created_at": datetime.now().isoformat(),
+            "status": BROADCAST_RUNNING,
+            "owner": None,
+            "lease_until": None,
+            "cursor": None,
+            "in_flight": [],
+            "sent": 0,
+            "failed": {},
+            "unknown": []
+        })
+        _set_broadcast_running(job_id, True)
+    return job_id
+
+def get_broadcast(job_id: str) -> Optional[Dict[str, Any]]:
+    """Возвращает задание рассылки."""
+    return _load_json(_broadcast_key(job_id)) or None
+
+def get_unfinished_broadcast_ids() -> List[str]:
+    """
+    Возвращает ID рассылок, которые еще не завершены.
+
+    ID читаются из списка незавершенных рассылок, поэтому время не зависит от количества завершенных.
+    Для хранилища, созданного до появления списка, он один раз строится перебором заданий.
+    """
+    index = _load_json(BROADCAST_INDEX_KEY)
+    if index:
+        return list(index["running"])
+
+    with _get_storage().transaction():
+        index = _load_json(BROADCAST_INDEX_KEY)
+        if not index:
+            index = {"running": _scan_unfinished_broadcast_ids()}
+            _save_json(BROADCAST_INDEX_KEY, index)
+    return list(index["running"])
+
+def claim_broadcast(job_id: str, owner: str) -> Optional[Dict[str, Any]]:
+    """
+    Захватывает незавершенную рассылку для выполнения (compare-and-set по сроку аренды).
+
+    Если прежний владелец не завершил пакет (например, процесс упал во время отправки),
+    получатели этого пакета переносятся в "unknown" и повторно не отправляются:
+    рассылка доставляет каждое сообщение не более одного раза.
+    Возвращает задание или None, если оно завершено или его выполняет другой процесс.
+    """
+    with _get_storage().transaction():
+        job = _load_json(_broadcast_key(job_id))
+        if not job or job['status'] != BROADCAST_RUNNING:
+            # Список незавершенных рассылок устарел (например, задание удалено вручную)
+            if job_id in _load_json(BROADCAST_INDEX_KEY).get("running", []):
+                _set_broadcast_running(job_id, False)
+            return None
+
+        now = datetime.now()
+        if job['owner'] not in (None, owner) and datetime.fromisoformat(job['lease_until']) > now:
+            return None
+
+        if job['in_flight']:
+            job['unknown'].extend(job['in_flight'])
+            job['cursor'] = max(job['in_flight'])
+            job['in_flight'] = []
+
+        job['owner'] = owner
+        job['lease_until'] = (now + BROADCAST_LEASE_TTL).isoformat()
+        _save_json(_broadcast_key(job_id), job)
+    return job
+
+def _update_owned_broadcast(job_id: str, owner: str, update) -> bool:
+    with _get_storage().transaction():
+        job = _load_json(_broadcast_key(job_id))
+        if not job or job['owner'] != owner or job['status'] != BROADCAST_RUNNING:
+            return False
+        update(job)
+        job['lease_until'] = (datetime.now() + BROADCAST_LEASE_TTL).isoformat()
+        _save_json(_broadcast_key(job_id), job)
+    return True
+
+def start_broadcast_batch(job_id: str, owner: str, recipient_ids: List[int]) -> bool:
+    """Записывает пакет получателей как отправляемый перед началом отправки."""
+    def update(job):
+        job['in_flight'] = recipient_ids
+    return _update_owned_broadcast(job_id, owner, update)
+
+def finish_broadcast_batch(job_id: str, owner: str, sent_ids: List[int], failures: Dict[int, str]) -> bool:
+    """Записывает результаты отправки пакета и сдвигает курсор рассылки."""
+    def update(job):
+        job['cursor'] = max(job['in_flight'])
+        job['in_flight'] = []
+        job['sent'] += len(sent_ids)
+        job['failed'].update({str(user_id): error for user_id, error in failures.items()})
+    return _update_owned_broadcast(job_id, owner, update)
+
+def complete_broadcast(job_id: str, owner: str, status: Optional[str] = None) -> bool:
+    """Завершает рассылку."""
+    def update(job):
+        job['status'] = status or BROADCAST_DONE
+        job['finished_at'] = datetime.now().isoformat()
+        _set_broadcast_running(job_id, False)
+    return _update_owned_broadcast(job_id, owner, update)
+
+def cancel_broadcast(job_id: str) -> bool:
+    """Отменяет незавершенную рассылку. Исполнитель остановится после текущего пакета."""
+    with _get_storage().transaction():
+        job = _load_json(_broadcast_key(job_id))
+        if not job or job['status'] != BROADCAST_RUNNING:
+            return False
+        job['status'] = BROADCAST_CANCELLED
+        job['finished_at'] = datetime.now().isoformat()
+        _save_json(_broadcast_key(job_id), job)
+        _set_broadcast_running(job_id, False)
+    return True
+
+def _legacy_files() -> Tuple[Optional[str], Optional[str]]:
+    """Пути к файлам старого формата для текущего хранилища или (None, None), если их там быть не может."""
+    legacy_dir = _get_storage().legacy_dir
+    if legacy_dir is None:
+        return None, None
+    return (os.path.join(legacy_dir, LEGACY_RAFFLES_FILENAME),
+            os.path.join(legacy_dir, LEGACY_PARTICIPANTS_FILENAME))
+
+def has_legacy_storage() -> bool:
+    """Проверяет, остались ли файлы старого формата (без разделения по каналам)."""
+    return any(path is not None and os.path.exists(path) for path in _legacy_files())
+
+def _read_legacy_file(file_path: str) -> Dict:
+    if not os.path.exists(file_path):
+        return {}
+    with open(file_path, 'r', encoding='utf-8') as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return {}
+
+def migrate_legacy_storage(chat_id: int, channel: Optional[str] = None) -> int:
+    """
+    Переносит розыгрыши старого формата (raffles.json, participants.json в директории хранилища)
+    в хранилище канала chat_id.
+
+    Старые ID розыгрышей (ID сообщения) заменяются на "<chat_id>_<message_id>",
+    а исходные файлы переименовываются в *.migrated. Возвращает количество перенесенных розыгрышей.
+    """
+    with _get_storage().transaction():
+        # Другой процесс мог уже выполнить перенос, пока мы ждали блокировку
+        if not has_legacy_storage():
+            return 0
+
+        legacy_raffles_file, legacy_participants_file = _legacy_files()
+        legacy_raffles = _read_legacy_file(legacy_raffles_file)
+        legacy_participants = _read_legacy_file(legacy_participants_file)
+
+        raffles = _load_json(_raffles_key(chat_id))
+        participants = _load_participants(chat_id)
+
+        for old_id, raffle_data in legacy_raffles.items():
+            message_id = int(raffle_data.get("message_id", old_id))
+            raffle_id = make_raffle_id(chat_id, message_id)
+            raffle_data = raffle_data.copy()
+            raffle_data["chat_id"] = chat_id
+            raffle_data["channel"] = channel
+            raffle_data["message_id"] = message_id
+            raffles[raffle_id] = raffle_data
+            participants[raffle_id] = legacy_participants.get(old_id, {})
+
+        _save_json(_raffles_key(chat_id), raffles)
+        _save_participants(chat_id, participants)
+
+        for legacy_file in (legacy_raffles_file, legacy_participants_file):
+            if os.path.exists(legacy_file):
+                shutil.move(legacy_file, legacy_file + '.migrated')
+
+    return len(legacy_raffles)
 
 # Обратная совместимость со старым методом
 def set_winner(raffle_id: str, winner_id: int) -> bool:
     """Устаревший метод для совместимости. Устанавливает одного победителя."""
-    return set_winners(raffle_id, [winner_id]) 
\ No newline at end of file
+    return set_winners(raffle_id, [winner_id])
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import secrets
+import sys
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sampling import WeightedSampler
+
+# Воспроизводимое определение победителей.
+#
+# 1. Снимок участников - список пар (user_id, билеты), отсортированный по user_id.
+#    Его хэш SHA-256 (строки "user_id:билеты\n") публикуется вместе с результатом.
+# 2. Случайные числа берутся из детерминированного генератора на SHA-256 от опубликованного сида,
+#    поэтому розыгрыш можно повторить на любом языке без зависимости от реализации random в Python.
+# 3. Кандидаты выбираются взвешенно без возвращения (sampling.WeightedSampler). Каждый проверенный
+#    кандидат записывается в протокол вместе с решением и причиной отказа.
+#
+# Повторить розыгрыш: python draw_engine.py audit.json (файл из команды /draw_audit).
+
+TRANSCRIPT_VERSION = 1
+
+# Причины, по которым кандидат не стал победителем
+REJECT_NOT_MEMBER = "not_member"
+REJECT_CHECK_FAILED = "check_failed"
+
+
+class DrawMismatchError(Exception):
+    """Повторное проведение розыгрыша не совпало с протоколом."""
+
+
+class SeededRng:
+    """
+    Детерминированный генератор случайных чисел: SHA-256("<seed>:<counter>") в режиме счетчика.
+
+    randrange(n) использует отбрасывание значений за пределами кратного n диапазона,
+    поэтому распределение равномерное без смещения.
+    """
+
+    def __init__(self, seed: str):
+        self.seed = seed
+        self.counter = 0
+
+    def _next_block(self) -> int:
+        digest = hashlib.sha256(f"{self.seed}:{self.counter}".encode('utf-8')).digest()
+        self.counter += 1
+        return int.from_bytes(digest, 'big')
+
+    def randrange(self, n: int) -> int:
+        if n <= 0:
+            raise ValueError("Диапазон должен быть положительным")
+        limit = (1 << 256) - (1 << 256) % n
+        while True:
+            value = self._next_block()
+            if value < limit:
+                return value % n
+
+
+def make_snapshot(participants: Iterable[Dict[str, Any]]) -> List[Tuple[int, int]]:
+    """Фиксирует порядок участников: пары (user_id, билеты), отсортированные по user_id."""
+    return sorted((int(p["user_id"]), int(p.get("tickets", 1))) for p in participants)
+
+
+def snapshot_hash(snapshot: List[Tuple[int, int]]) -> str:
+    """Хэш снимка участников, публикуемый вместе с результатом."""
+    digest = hashlib.sha256()
+    for user_id, tickets in snapshot:
+        digest.update(f"{user_id}:{tickets}\n".encode('ascii'))
+    return digest.hexdigest()
+
+
+def new_seed() -> str:
+    """Случайный сид для нового розыгрыша."""
+    return secrets.token_hex(16)
+
+
+class Draw:
+    """
+    Проведение одного розыгрыша с протоколом.
+
+    Вызывающий код получает кандидатов через next_candidate() и сообщает решение через
+    accept()/reject(). Количество проверок равно числу победителей плюс число отклоненных кандидатов.
+    """
+
+    def __init__(self, snapshot: List[Tuple[int, int]], seed: str, winners_count: int):
+        self.snapshot = snapshot
+        self.seed = seed
+        self.winners_count = winners_count
+        self.winners: List[int] = []
+        self.candidates: List[Dict[str, Any]] = []
+        self._rng = SeededRng(seed)
+        self._sampler = WeightedSampler([tickets for _, tickets in snapshot])
+        self._pending: Optional[int] = None
+
+    @property
+    def finished(self) -> bool:
+        """Выбраны все победители или кандидаты закончились."""
+        return len(self.winners) >= self.winners_count or not self._sampler.remaining
+
+    def next_candidate(self) -> int:
+        """Возвращает user_id следующего кандидата."""
+        if self._pending is not None:
+            raise RuntimeError("Решение по предыдущему кандидату еще не принято")
+        self._pending = self.snapshot[self._sampler.draw(self._rng)][0]
+        return self._pending
+
+    def accept(self) -> None:
+        """Кандидат становится победителем."""
+        self.candidates.append({"user_id": self._pending, "accepted": True})
+        self.winners.append(self._pending)
+        self._pending = None
+
+    def reject(self, reason: str) -> None:
+        """Кандидат исключается из розыгрыша по причине reason."""
+        self.candidates.append({"user_id": self._pending, "accepted": False, "reason": reason})
+        self._pending = None
+
+    def transcript(self, raffle_id: str) -> Dict[str, Any]:
+        """Компактный протокол розыгрыша (без списка участников - только его хэш)."""
+        return {
+            "version": TRANSCRIPT_VERSION,
+            "raffle_id": raffle_id,
+            "seed": self.seed,
+            "snapshot_hash": snapshot_hash(self.snapshot),
+            "participants_count": len(self.snapshot),
+            "total_tickets": sum(tickets for _, tickets in self.snapshot),
+            "winners_count": self.winners_count,
+            "candidates": self.candidates,
+            "winners": self.winners
+        }
+
+
+def replay(snapshot: List[Tuple[int, int]], transcript: Dict[str, Any]) -> List[int]:
+    """
+    Повторяет розыгрыш по снимку участников и протоколу.
+
+    Решения по кандидатам (подписан или нет) берутся из протокола, все остальное пересчитывается.
+    Возвращает список победителей или выбрасывает DrawMismatchError при любом расхождении.
+    """
+    snapshot = sorted((int(user_id), int(tickets)) for user_id, tickets in snapshot)
+    if snapshot_hash(snapshot) != transcript["snapshot_hash"]:
+        raise DrawMismatchError("Хэш снимка участников не совпадает с протоколом")
+
+    draw = Draw(snapshot, transcript["seed"], transcript["winners_count"])
+    for recorded in transcript["candidates"]:
+        if draw.finished:
+            raise DrawMismatchError("В протоколе больше кандидатов, чем было выбрано")
+        candidate = draw.next_candidate()
+        if candidate != recorded["user_id"]:
+            raise DrawMismatchError(
+                f"Кандидат #{len(draw.candidates) + 1}: ожидался {recorded['user_id']}, выбран {candidate}"
+            )
+        if recorded["accepted"]:
+            draw.accept()
+        else:
+            draw.reject(recorded.get("reason", ""))
+
+    if draw.winners != transcript["winners"]:
+        raise DrawMismatchError("Список победителей не совпадает с протоколом")
+    return draw.winners
+
+
+def main() -> None:
+    """Проверка розыгрыша из файла, выгруженного командой /draw_audit."""
+    if len(sys.argv) != 2:
+        print("Использование: python draw_engine.py audit.json")
+        sys.exit(2)
+
+    with open(sys.argv[1], 'r', encoding='utf-8') as f:
+        audit = json.load(f)
+
+    try:
+        winners = replay(audit["participants"], audit["transcript"])
+    except DrawMismatchError as e:
+        print(f"Розыгрыш НЕ подтвержден: {e}")
+        sys.exit(1)
+
+    print(f"Розыгрыш подтвержден. Победители: {', '.join(str(winner) for winner in winners)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+# Статистика регистраций в розыгрыше по времени.
+#
+# Счетчики обновляются при каждой регистрации, поэтому их чтение не зависит от количества участников:
+# - количество регистраций по часам ("YYYY-MM-DDTHH" -> количество);
+# - точные счетчики последних RECENT_MINUTES минут и несколько минут с наибольшим количеством регистраций.
+# Минута, вышедшая из окна последних минут, претендует на место среди пиковых; минуты, не попавшие в список
+# пиковых, не хранятся: размер статистики зависит только от длительности розыгрыша.
+#
+# Процессы бота с общим хранилищем записывают регистрации с временем по своим часам, поэтому регистрации
+# приходят не строго по порядку. Внутри окна последних минут они учитываются точно. Регистрация старше окна
+# добавляется к пиковой минуте, если та еще в списке; иначе минута возвращается в список только с этой
+# регистрацией, и ее пиковое значение может быть занижено (для этого часы процессов должны расходиться
+# больше чем на RECENT_MINUTES минут).
+
+STATS_VERSION = 2
+
+# Сколько пиковых минут хранить
+PEAK_MINUTES = 5
+
+# Сколько последних минут считать точно
+RECENT_MINUTES = 10
+
+# Символы спарклайна от меньшего значения к большему
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+HOUR_FORMAT = "%Y-%m-%dT%H"
+MINUTE_FORMAT = "%Y-%m-%dT%H:%M"
+
+
+class JoinStats:
+    """Счетчики регистраций одного розыгрыша."""
+
+    def __init__(self, data: Optional[Dict[str, Any]] = None):
+        data = data or {}
+        self.total: int = data.get("total", 0)
+        self.first_join: Optional[str] = data.get("first_join")
+        self.last_join: Optional[str] = data.get("last_join")
+        self.hours: Dict[str, int] = data.get("hours", {})
+        self.recent_minutes: Dict[str, int] = data.get("recent_minutes", {})
+        if "minute" in data and data["minute"]:
+            # Статистика версии 1 хранила только счетчик текущей минуты
+            minute, count = data["minute"]
+            self.recent_minutes[minute] = count
+        self.peak_minutes: List[List] = data.get("peak_minutes", [])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "version": STATS_VERSION,
+            "total": self.total,
+            "first_join": self.first_join,
+            "last_join": self.last_join,
+            "hours": self.hours,
+            "recent_minutes": self.recent_minutes,
+            "peak_minutes": self.peak_minutes
+        }
+
+    def _add_peak(self, minute: str, count: int) -> None:
+        for peak in self.peak_minutes:
+            if peak[0] == minute:
+                peak[1] += count
+                break
+        else:
+            self.peak_minutes.append([minute, count])
+        self.peak_minutes.sort(key=lambda peak: (-peak[1], peak[0]))
+        del self.peak_minutes[PEAK_MINUTES:]
+
+    def _count(self, joined_at: datetime) -> None:
+        """Обновляет общее количество, счетчик часа и время первой и последней регистрации."""
+        timestamp = joined_at.isoformat()
+        hour = joined_at.strftime(HOUR_FORMAT)
+        self.total += 1
+        self.hours[hour] = self.hours.get(hour, 0) + 1
+        if self.first_join is None or timestamp < self.first_join:
+            self.first_join = timestamp
+        if self.last_join is None or timestamp > self.last_join:
+            self.last_join = timestamp
+
+    def _window_start(self) -> str:
+        """Самая ранняя минута окна последних минут."""
+        latest = datetime.strptime(max(self.recent_minutes), MINUTE_FORMAT)
+        return (latest - timedelta(minutes=RECENT_MINUTES - 1)).strftime(MINUTE_FORMAT)
+
+    def _close_minutes(self) -> None:
+        """Минуты, вышедшие из окна последних минут, претендуют на место среди пиковых."""
+        window_start = self._window_start()
+        for minute in [minute for minute in self.recent_minutes if minute < window_start]:
+            self._add_peak(minute, self.recent_minutes.pop(minute))
+
+    def record(self, joined_at: datetime) -> None:
+        """Учитывает одну регистрацию."""
+        self._count(joined_at)
+
+        minute = joined_at.strftime(MINUTE_FORMAT)
+        if self.recent_minutes and minute < self._window_start():
+            # Регистрация старше окна (часы другого процесса сильно отстают)
+            self._add_peak(minute, 1)
+            return
+        self.recent_minutes[minute] = self.recent_minutes.get(minute, 0) + 1
+        self._close_minutes()
+
+    @classmethod
+    def backfill(cls, joined_at_values: Iterable[Union[datetime, str, None]]) -> "JoinStats":
+        """
+        Строит статистику по времени регистрации уже сохраненных участников (datetime или строки ISO).
+
+        Значения перебираются по одному, кроме них в памяти хранятся только счетчики по минутам.
+        Результат совпадает со статистикой, которая получилась бы при учете каждой регистрации через record().
+        """
+        stats = cls()
+        minutes: Counter = Counter()
+        for value in joined_at_values:
+            joined_at = value
+            if not isinstance(value, datetime):
+                try:
+                    joined_at = datetime.fromisoformat(value)
+                except (TypeError, ValueError):
+                    joined_at = None
+            if joined_at is None:
+                # Участники из старых версий бота без корректного времени регистрации
+                stats.total += 1
+                continue
+
+            stats._count(joined_at)
+            minutes[joined_at.strftime(MINUTE_FORMAT)] += 1
+
+        if minutes:
+            stats.recent_minutes = dict(minutes)
+            window_start = stats._window_start()
+            closed = [[minute, stats.recent_minutes.pop(minute)] for minute in minutes if minute < window_start]
+            stats.peak_minutes = sorted(closed, key=lambda peak: (-peak[1], peak[0]))[:PEAK_MINUTES]
+        return stats
+
+    def top_minutes(self) -> List[Tuple[str, int]]:
+        """Минуты с наибольшим количеством регистраций (с учетом последних минут)."""
+        candidates = [tuple(peak) for peak in self.peak_minutes]
+        candidates.extend(self.recent_minutes.items())
+        return sorted(candidates, key=lambda peak: (-peak[1], peak[0]))[:PEAK_MINUTES]
+
+    def hourly(self) -> List[Tuple[str, int]]:
+        """Количество регистраций по часам от первой до последней регистрации, включая часы без регистраций."""
+        if not self.hours:
+            return []
+        start = datetime.strptime(min(self.hours), HOUR_FORMAT)
+        end = datetime.strptime(max(self.hours), HOUR_FORMAT)
+        result = []
+        hour = start
+        while hour <= end:
+            key = hour.strftime(HOUR_FORMAT)
+            result.append((key, self.hours.get(key, 0)))
+            hour += timedelta(hours=1)
+        return result
+
+
+def sparkline(values: List[int], width: int = 48) -> str:
+    """Текстовый график: значения группируются в не больше width столбиков."""
+    if not values:
+        return ""
+    group = -(-len(values) // width)
+    columns = [sum(values[i:i + group]) for i in range(0, len(values), group)]
+    highest = max(columns)
+    if highest == 0:
+        return SPARK_CHARS[0] * len(columns)
+    return "".join(SPARK_CHARS[value * (len(SPARK_CHARS) - 1) // highest] for value in columns)
+
+
+def format_report(raffle_id: str, data: Dict[str, Any], table_hours: int = 12) -> str:
+    """Текстовый отчет о регистрациях: спарклайны по часам, таблица последних часов и пиковые минуты."""
+    stats = JoinStats(data)
+    lines = [f"Статистика регистраций розыгрыша {raffle_id}", f"Всего участников: {stats.total}"]
+    if not stats.first_join:
+        return "\n".join(lines)
+
+    first_join = datetime.fromisoformat(stats.first_join).strftime("%Y-%m-%d %H:%M")
+    last_join = datetime.fromisoformat(stats.last_join).strftime("%Y-%m-%d %H:%M")
+    lines.append(f"Первая регистрация: {first_join}, последняя: {last_join}")
+
+    hourly = stats.hourly()
+    counts = [count for _, count in hourly]
+    growth = []
+    for count in counts:
+        growth.append((growth[-1] if growth else 0) + count)
+    lines.append("")
+    lines.append(f"Регистрации по часам ({len(hourly)} ч): {sparkline(counts)}")
+    lines.append(f"Рост числа участников: {sparkline(growth)}")
+
+    lines.append("")
+    lines.append("Последние часы:")
+    highest = max(counts[-table_hours:]) or 1
+    for hour, count in hourly[-table_hours:]:
+        label = datetime.strptime(hour, HOUR_FORMAT).strftime("%m-%d %H:00")
+        bar = SPARK_CHARS[-1] * max(1 if count else 0, count * 10 // highest)
+        lines.append(f"{label} {count:>6} {bar}")
+
+    peaks = stats.top_minutes()
+    if peaks:
+        lines.append("")
+        lines.append("Пиковые минуты:")
+        for index, (minute, count) in enumerate(peaks, 1):
+            label = datetime.strptime(minute, MINUTE_FORMAT).strftime("%Y-%m-%d %H:%M")
+            lines.append(f"{index}. {label} - {count}")
+
+    return "\n".join(lines)
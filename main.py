@@ -1,9 +1,16 @@
 import os
-import random
+import asyncio
+import html
+import json
+import socket
+import time
+import uuid
 import logging
 from datetime import datetime, timedelta
+from typing import Any, Dict
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -16,20 +23,16 @@ from telegram.ext import (
 )
 
 import database as db
+from persistence import StoragePersistence
+import admission
+import broadcast
+import draw_engine
+import join_stats
 
-# Загрузка переменных окружения
-load_dotenv()
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-CHANNEL_USERNAME = os.getenv("CHANNEL_USERNAME")
-
-# Настройка логирования
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
 # Константы для разговора
-TEXT, ASK_PHOTO, PHOTO, WINNERS_COUNT = range(4)  # Добавляем состояния для обработки фото
+TEXT, ASK_PHOTO, PHOTO, WINNERS_COUNT, CHANNEL = range(5)  # Добавляем состояния для обработки фото и выбора канала
 
 # Время ожидания ответа в секундах (10 минут)
 CONVERSATION_TIMEOUT = 600
@@ -37,10 +40,132 @@ CONVERSATION_TIMEOUT = 600
 # Стандартная продолжительность розыгрыша в днях (используется для внутренней логики)
 DEFAULT_RAFFLE_DURATION_DAYS = 30
 
+# Сколько последних завершенных розыгрышей показывать в /raffle_info
+ARCHIVED_RAFFLES_IN_INFO = 5
+
+# Статусы, при которых пользователь считается подписчиком канала
+MEMBER_STATUSES = ['member', 'administrator', 'creator']
+
+def load_config() -> Dict[str, Any]:
+    """
+    Читает настройки бота из переменных окружения (и файла .env).
+
+    Настройки читаются при запуске, а не при импорте модуля, поэтому в одном процессе можно
+    создать несколько экземпляров бота с разными настройками (см. build_application).
+    """
+    load_dotenv()
+    channel_username = os.getenv("CHANNEL_USERNAME")
+    return {
+        "bot_token": os.getenv("BOT_TOKEN"),
+        "channel_username": channel_username,
+        # Список каналов, которые обслуживает бот (через запятую).
+        # Если не задан, используется единственный канал из CHANNEL_USERNAME.
+        "channel_usernames": [
+            channel.strip()
+            for channel in (os.getenv("CHANNEL_USERNAMES") or channel_username or "").split(",")
+            if channel.strip()
+        ],
+        # Хранилище данных: "json" (файлы в data/, один процесс) или "sqlite" (общее для нескольких процессов)
+        "storage_backend": os.getenv("STORAGE_BACKEND", "json"),
+        "storage_path": os.getenv("STORAGE_PATH"),
+        # Режим webhook: если WEBHOOK_URL задан, бот принимает обновления по HTTP вместо polling.
+        # Несколько процессов бота с общим хранилищем SQLite могут работать за одним балансировщиком.
+        "webhook_url": os.getenv("WEBHOOK_URL"),
+        "webhook_listen": os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+        "webhook_port": int(os.getenv("WEBHOOK_PORT", "8443")),
+        "webhook_secret": os.getenv("WEBHOOK_SECRET"),
+        # Как часто (в секундах) сохранять данные пользователей и состояния разговоров
+        "persistence_interval": float(os.getenv("PERSISTENCE_INTERVAL", "5")),
+        # Скорость рассылок (сообщений в секунду) и количество одновременных запросов к Bot API
+        "broadcast_rate": float(os.getenv("BROADCAST_RATE", str(broadcast.DEFAULT_RATE))),
+        "broadcast_workers": int(os.getenv("BROADCAST_WORKERS", str(broadcast.DEFAULT_WORKERS))),
+        # Ограничения нажатий "Участвую": частота для одного пользователя (нажатий в секунду и запас подряд)
+        # и количество нажатий, которые процесс обрабатывает одновременно
+        "click_rate": float(os.getenv("CLICK_RATE", "0.5")),
+        "click_burst": float(os.getenv("CLICK_BURST", "3")),
+        "max_in_flight_clicks": int(os.getenv("MAX_IN_FLIGHT_CLICKS", "100")),
+        # ID администраторов бота (через запятую) для команд, изменяющих шансы участников, и рассылок
+        "admin_ids": {int(admin_id) for admin_id in (os.getenv("ADMIN_IDS") or "").split(",") if admin_id.strip()}
+    }
+
+def get_config(context: ContextTypes.DEFAULT_TYPE) -> Dict[str, Any]:
+    """Настройки экземпляра бота, обрабатывающего обновление."""
+    return context.bot_data["config"]
+
+def channel_title(raffle: dict) -> str:
+    """Возвращает название канала розыгрыша для сообщений пользователю."""
+    return raffle.get("channel") or str(raffle.get("chat_id", ""))
+
+def is_admin(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
+    """Проверяет, входит ли пользователь в список администраторов ADMIN_IDS."""
+    return user_id in get_config(context)["admin_ids"]
+
+def referral_link(bot_username: str, raffle_id: str, user_id: int) -> str:
+    """Личная ссылка участника для приглашения друзей в розыгрыш."""
+    return f"https://t.me/{bot_username}?start=ref_{raffle_id}_{user_id}"
+
+async def is_channel_member(context: ContextTypes.DEFAULT_TYPE, chat_id, user_id: int) -> bool:
+    """Проверяет, подписан ли пользователь на канал розыгрыша."""
+    chat_member = await context.bot.get_chat_member(chat_id, user_id)
+    return chat_member.status in MEMBER_STATUSES
+
+def participate_keyboard(participants_count: int = 0) -> InlineKeyboardMarkup:
+    """Клавиатура поста розыгрыша с количеством участников на кнопке."""
+    label = f"Участвую ({participants_count})" if participants_count else "Участвую"
+    return InlineKeyboardMarkup([[InlineKeyboardButton(label, callback_data="participate")]])
+
+async def refresh_participants_counter(context: ContextTypes.DEFAULT_TYPE, raffle: dict) -> bool:
+    """Обновляет счетчик участников на кнопке под постом розыгрыша."""
+    raffle_id = raffle["raffle_id"]
+    counter = context.bot_data.setdefault("participant_counters", {}).setdefault(
+        raffle_id, {"lock": asyncio.Lock(), "shown": None}
+    )
+
+    # Нажатия обрабатываются параллельно: обновления одного поста выполняются по очереди, а количество
+    # читается прямо перед запросом, чтобы счетчик не уменьшался из-за ответов, пришедших не по порядку
+    async with counter["lock"]:
+        participants_count = db.count_participants(raffle_id)
+        if participants_count == counter["shown"]:
+            return True
+        try:
+            # Меняется только клавиатура: текст и фото поста не передаются повторно
+            await context.bot.edit_message_reply_markup(
+                chat_id=raffle["chat_id"],
+                message_id=raffle["message_id"],
+                reply_markup=participate_keyboard(participants_count)
+            )
+            counter["shown"] = participants_count
+            return True
+        except BadRequest as e:
+            # Счетчик уже показывает это значение (например, его обновил другой процесс бота)
+            if "message is not modified" in str(e).lower():
+                counter["shown"] = participants_count
+                return True
+            logger.error(f"Ошибка при обновлении счетчика розыгрыша {raffle_id}: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении счетчика розыгрыша {raffle_id}: {e}")
+    return False
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /start."""
+    # Переход по реферальной ссылке: /start ref_<raffle_id>_<user_id пригласившего>
+    if context.args and context.args[0].startswith("ref_"):
+        try:
+            raffle_id, referrer_id = context.args[0][len("ref_"):].rsplit("_", 1)
+            raffle = db.get_raffle(raffle_id)
+            if raffle and raffle.get("is_active", False):
+                # Запоминаем пригласившего до нажатия кнопки "Участвую"
+                context.user_data.setdefault("referrals", {})[raffle_id] = int(referrer_id)
+                await update.message.reply_text(
+                    f"Вас пригласили в розыгрыш в канале {channel_title(raffle)}! "
+                    "Подпишитесь на канал и нажмите кнопку \"Участвую\" под постом розыгрыша."
+                )
+                return
+        except ValueError:
+            logger.info(f"Некорректная реферальная ссылка: {context.args[0]}")
+    
     await update.message.reply_text(
-        f"Привет! Я бот для проведения розыгрышей в канале {CHANNEL_USERNAME}.\n"
+        f"Привет! Я бот для проведения розыгрышей в каналах: {', '.join(get_config(context)['channel_usernames'])}.\n"
         "Используйте /create_raffle для создания нового розыгрыша.\n"
         "Используйте /list_raffles для просмотра активных розыгрышей.\n"
         "Используйте /raffle_info для просмотра подробной информации о розыгрыше.\n"
@@ -207,14 +332,57 @@ async def raffle_winners_count(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         return ConversationHandler.END
     
+    context.user_data["winners_count"] = winners_count
+    
+    # Если бот обслуживает несколько каналов, спрашиваем, в каком опубликовать розыгрыш
+    channel_usernames = get_config(context)["channel_usernames"]
+    if len(channel_usernames) > 1:
+        keyboard = [
+            [InlineKeyboardButton(channel, callback_data=f"channel_{index}")]
+            for index, channel in enumerate(channel_usernames)
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        await update.message.reply_text(
+            "Выберите канал для публикации розыгрыша:",
+            reply_markup=reply_markup
+        )
+        return CHANNEL
+    
+    return await publish_raffle(update, context, channel_usernames[0])
+
+async def raffle_channel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Обработка выбора канала для публикации розыгрыша."""
+    try:
+        query = update.callback_query
+        await query.answer()
+        
+        index = int(query.data.replace("channel_", ""))
+        channel_usernames = get_config(context)["channel_usernames"]
+        if index < 0 or index >= len(channel_usernames):
+            await query.edit_message_text("Этот канал больше не обслуживается ботом. Выберите другой канал.")
+            return CHANNEL
+        
+        channel = channel_usernames[index]
+        await query.edit_message_text(f"Публикуем розыгрыш в канале {channel}...")
+        return await publish_raffle(update, context, channel)
+    except Exception as e:
+        logger.error(f"Error in raffle_channel_callback: {e}")
+        await update.effective_chat.send_message(
+            "Произошла ошибка. Пожалуйста, используйте /reset и попробуйте снова."
+        )
+        return ConversationHandler.END
+
+async def publish_raffle(update: Update, context: ContextTypes.DEFAULT_TYPE, channel: str) -> int:
+    """Публикация поста розыгрыша в выбранном канале и сохранение розыгрыша."""
     try:
         raffle_text = context.user_data["raffle_text"]
         raffle_photo = context.user_data.get("raffle_photo")
         end_date = context.user_data["end_date"]
+        winners_count = context.user_data["winners_count"]
         
         # Создаем клавиатуру
-        keyboard = [[InlineKeyboardButton("Участвую", callback_data="participate")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = participate_keyboard()
         
         # Используем только текст пользователя без добавления даты окончания
         post_text = raffle_text
@@ -224,7 +392,7 @@ async def raffle_winners_count(update: Update, context: ContextTypes.DEFAULT_TYP
             # Если есть фото, отправляем сообщение с фото
             if raffle_photo:
                 message = await context.bot.send_photo(
-                    chat_id=CHANNEL_USERNAME,
+                    chat_id=channel,
                     photo=raffle_photo,
                     caption=post_text,
                     reply_markup=reply_markup
@@ -232,23 +400,20 @@ async def raffle_winners_count(update: Update, context: ContextTypes.DEFAULT_TYP
             # Иначе отправляем только текст
             else:
                 message = await context.bot.send_message(
-                    chat_id=CHANNEL_USERNAME,
+                    chat_id=channel,
                     text=post_text,
                     reply_markup=reply_markup
                 )
             
-            # Сохраняем розыгрыш в базе данных
-            raffle_id = db.create_raffle(message.message_id, raffle_text, end_date, winners_count)
-            
-            # Если было фото, сохраняем его ID
-            if raffle_photo:
-                # Здесь можно было бы добавить в базу данных сохранение ссылки на фото,
-                # но это потребует изменения структуры БД
-                logger.info(f"Raffle {raffle_id} created with photo")
+            # Сохраняем розыгрыш в базе данных канала вместе с данными поста
+            raffle_id = db.create_raffle(
+                message.chat.id, message.message_id, raffle_text, end_date, winners_count,
+                channel=channel, photo=raffle_photo
+            )
             
             winners_text = "победитель" if winners_count == 1 else "победителей"
-            await update.message.reply_text(
-                f"Розыгрыш успешно создан! ID розыгрыша: {raffle_id}\n"
+            await update.effective_chat.send_message(
+                f"Розыгрыш успешно создан в канале {channel}! ID розыгрыша: {raffle_id}\n"
                 f"Количество {winners_text}: {winners_count}"
             )
             
@@ -257,15 +422,15 @@ async def raffle_winners_count(update: Update, context: ContextTypes.DEFAULT_TYP
             
         except Exception as e:
             logger.error(f"Error creating raffle: {e}")
-            await update.message.reply_text(
+            await update.effective_chat.send_message(
                 f"Ошибка при создании розыгрыша: {str(e)}\n"
-                f"Проверьте, добавлен ли бот в администраторы канала {CHANNEL_USERNAME}"
+                f"Проверьте, добавлен ли бот в администраторы канала {channel}"
             )
             return ConversationHandler.END
         
         return ConversationHandler.END
     except Exception as e:
-        logger.error(f"Unexpected error in raffle_winners_count: {e}")
+        logger.error(f"Unexpected error in publish_raffle: {e}")
         await update.effective_chat.send_message(
             "Произошла непредвиденная ошибка. Пожалуйста, используйте /reset и попробуйте снова."
         )
@@ -298,6 +463,40 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def participate_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработка нажатия на кнопку 'Участвую'."""
     query = update.callback_query
+    user_id = query.from_user.id
+    
+    # ID розыгрыша составляется из ID канала и ID сообщения
+    raffle_id = db.make_raffle_id(query.message.chat.id, query.message.message_id)
+    
+    # Слишком частые, повторные и лишние при перегрузке нажатия отклоняются дешевым ответом
+    # без обращения к хранилищу и Bot API
+    click_admission = context.bot_data["click_admission"]
+    if not click_admission.allow_user(user_id):
+        await query.answer("Слишком много нажатий. Подождите несколько секунд.")
+        return
+    
+    key = (user_id, raffle_id)
+    decision = click_admission.begin(key)
+    if decision == admission.DUPLICATE:
+        await query.answer("Ваша заявка уже обрабатывается.")
+        return
+    if decision == admission.OVERLOADED:
+        await query.answer("Сейчас очень много желающих. Нажмите еще раз через несколько секунд.", show_alert=True)
+        return
+    
+    try:
+        # Уже зарегистрированным участникам отвечаем сразу, без проверки подписки и личных сообщений
+        if db.is_participant(raffle_id, user_id):
+            await query.answer("Вы уже зарегистрированы для участия в этом розыгрыше.", show_alert=True)
+            return
+        
+        await process_participation(update, context, raffle_id)
+    finally:
+        click_admission.end(key)
+
+async def process_participation(update: Update, context: ContextTypes.DEFAULT_TYPE, raffle_id: str) -> None:
+    """Регистрация пользователя в розыгрыше."""
+    query = update.callback_query
     await query.answer()
     
     # Информация о пользователе
@@ -307,9 +506,6 @@ async def participate_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     first_name = user.first_name or ""
     last_name = user.last_name or ""
     
-    # ID сообщения используется как ID розыгрыша
-    raffle_id = str(query.message.message_id)
-    
     # Проверяем, что розыгрыш существует и активен
     raffle = db.get_raffle(raffle_id)
     if not raffle or not raffle.get("is_active", False):
@@ -325,17 +521,16 @@ async def participate_callback(update: Update, context: ContextTypes.DEFAULT_TYP
             await query.answer("Этот розыгрыш уже завершен", show_alert=True)
         return
     
-    # Проверяем, подписан ли пользователь на канал
+    # Проверяем, подписан ли пользователь на канал розыгрыша
     try:
-        chat_member = await context.bot.get_chat_member(CHANNEL_USERNAME, user_id)
-        is_member = chat_member.status in ['member', 'administrator', 'creator']
+        is_member = await is_channel_member(context, raffle["chat_id"], user_id)
         
         if not is_member:
             try:
                 # Пытаемся отправить личное сообщение
                 await context.bot.send_message(
                     chat_id=user_id,
-                    text=f"Для участия в розыгрыше необходимо быть подписанным на канал {CHANNEL_USERNAME}."
+                    text=f"Для участия в розыгрыше необходимо быть подписанным на канал {channel_title(raffle)}."
                 )
             except Exception as e:
                 logger.error(f"Не удалось отправить личное сообщение пользователю: {e}")
@@ -344,59 +539,36 @@ async def participate_callback(update: Update, context: ContextTypes.DEFAULT_TYP
             return
         
         # Добавляем пользователя как участника
-        is_new = db.add_participant(raffle_id, user_id, username, first_name, last_name)
-        
-        # Подготовим данные о количестве участников для обновления сообщения
-        participants_count = len(db.get_participants(raffle_id))
+        # Если пользователь пришел по реферальной ссылке, пригласивший получит дополнительный билет
+        referred_by = context.user_data.get("referrals", {}).get(raffle_id)
+        is_new = db.add_participant(raffle_id, user_id, username, first_name, last_name, referred_by=referred_by)
         
         if is_new:
             try:
                 # Пытаемся отправить личное сообщение
                 await context.bot.send_message(
                     chat_id=user_id,
-                    text=f"Вы успешно зарегистрированы для участия в розыгрыше!"
+                    text=f"Вы успешно зарегистрированы для участия в розыгрыше!\n\n"
+                         f"Приглашайте друзей по личной ссылке - за каждого участника "
+                         f"вы получите дополнительный билет:\n"
+                         f"{referral_link(context.bot.username, raffle_id, user_id)}"
                 )
             except Exception as e:
                 logger.error(f"Не удалось отправить личное сообщение пользователю: {e}")
                 # Если не получилось отправить личное сообщение, ничего критичного не происходит
                 # Пользователь увидит обновленное сообщение с счетчиком участников
             
-            # Обновляем сообщение с розыгрышем, показывая количество участников
-            try:
-                # Получаем оригинальную клавиатуру
-                original_keyboard = query.message.reply_markup.inline_keyboard
-                
-                # Создаем новую клавиатуру с актуальной информацией об участниках
-                keyboard = [[InlineKeyboardButton(f"Участвую ({participants_count})", callback_data="participate")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                # Определяем, есть ли у сообщения фото
-                if query.message.photo:
-                    # Если это сообщение с фото
-                    await context.bot.edit_message_caption(
-                        chat_id=query.message.chat.id,
-                        message_id=query.message.message_id,
-                        caption=query.message.caption,
-                        reply_markup=reply_markup
-                    )
-                else:
-                    # Если это текстовое сообщение
-                    await context.bot.edit_message_text(
-                        chat_id=query.message.chat.id,
-                        message_id=query.message.message_id,
-                        text=query.message.text,
-                        reply_markup=reply_markup
-                    )
-            except Exception as e:
-                logger.error(f"Ошибка при обновлении сообщения розыгрыша: {e}")
-                # Если не получилось обновить сообщение, просто логируем ошибку
+            # Обновляем счетчик участников на кнопке под постом розыгрыша
+            await refresh_participants_counter(context, raffle)
         else:
+            # Участник не добавлен: он уже зарегистрирован или розыгрыш завершился во время проверки подписки
+            if db.is_participant(raffle_id, user_id):
+                text = "Вы уже зарегистрированы для участия в этом розыгрыше."
+            else:
+                text = "Извините, этот розыгрыш уже завершен или не существует."
             try:
                 # Пытаемся отправить личное сообщение
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=f"Вы уже зарегистрированы для участия в этом розыгрыше."
-                )
+                await context.bot.send_message(chat_id=user_id, text=text)
             except Exception as e:
                 logger.error(f"Не удалось отправить личное сообщение пользователю: {e}")
                 # Если не получилось отправить личное сообщение, ничего критичного не происходит
@@ -412,6 +584,48 @@ async def participate_callback(update: Update, context: ContextTypes.DEFAULT_TYP
             # Если отправка сообщения не удалась, просто логируем ошибку
             logger.error("Не удалось отправить сообщение об ошибке пользователю")
 
+async def add_tickets_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Начисление дополнительных билетов участнику: /add_tickets <ID розыгрыша> <ID пользователя> <количество>."""
+    if not is_admin(context, update.effective_user.id):
+        await update.message.reply_text("Эта команда доступна только администраторам бота (ADMIN_IDS).")
+        return
+    
+    try:
+        raffle_id, user_id, tickets = context.args[0], int(context.args[1]), int(context.args[2])
+    except (IndexError, ValueError):
+        await update.message.reply_text(
+            "Использование: /add_tickets <ID розыгрыша> <ID пользователя> <количество билетов>\n"
+            "Например, бонус постоянному подписчику: /add_tickets -1001234567890_42 123456789 2"
+        )
+        return
+    
+    total = db.add_tickets(raffle_id, user_id, tickets)
+    if total is None:
+        await update.message.reply_text("Розыгрыш не активен или пользователь в нем не участвует.")
+        return
+    
+    await update.message.reply_text(f"Готово! Теперь у участника {user_id} билетов: {total}.")
+
+async def raffle_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Статистика регистраций по времени: /raffle_stats <ID розыгрыша>."""
+    if not is_admin(context, update.effective_user.id):
+        await update.message.reply_text("Эта команда доступна только администраторам бота (ADMIN_IDS).")
+        return
+    
+    if len(context.args) != 1:
+        await update.message.reply_text("Использование: /raffle_stats <ID розыгрыша>")
+        return
+    
+    raffle_id = context.args[0]
+    stats = db.get_join_stats(raffle_id)
+    if stats is None:
+        await update.message.reply_text("Розыгрыш не найден.")
+        return
+    
+    # Моноширинный шрифт, чтобы таблица по часам не разъезжалась
+    report = join_stats.format_report(raffle_id, stats)
+    await update.message.reply_text(f"<pre>{html.escape(report)}</pre>", parse_mode="HTML")
+
 async def list_raffles(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает список активных розыгрышей."""
     active_raffles = db.get_active_raffles()
@@ -423,10 +637,11 @@ async def list_raffles(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     reply_text = "Активные розыгрыши:\n\n"
     for raffle in active_raffles:
         end_date = datetime.fromisoformat(raffle["end_date"]).strftime("%Y-%m-%d %H:%M")
-        participants_count = len(db.get_participants(raffle["raffle_id"]))
+        participants_count = db.count_participants(raffle["raffle_id"])
         winners_count = raffle.get("winners_count", 1)
         
         reply_text += f"ID: {raffle['raffle_id']}\n"
+        reply_text += f"Канал: {channel_title(raffle)}\n"
         reply_text += f"Текст: {raffle['text'][:50]}...\n"
         reply_text += f"Дата окончания: {end_date}\n"
         reply_text += f"Участников: {participants_count}\n"
@@ -438,19 +653,22 @@ async def list_raffles(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 async def raffle_info_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Команда для получения подробной информации о розыгрыше."""
-    # Получаем список всех розыгрышей (активных и неактивных)
+    # Получаем список активных розыгрышей и последних завершенных (они загружаются из архива только при выборе)
     active_raffles = db.get_active_raffles()
+    archived_raffle_ids = db.get_recently_archived_raffle_ids()[:ARCHIVED_RAFFLES_IN_INFO]
     
-    if not active_raffles:
+    if not active_raffles and not archived_raffle_ids:
         await update.message.reply_text("В настоящее время нет активных розыгрышей.")
         return
     
     # Создаем клавиатуру для выбора розыгрыша
     keyboard = []
     for raffle in active_raffles:
-        participants_count = len(db.get_participants(raffle["raffle_id"]))
+        participants_count = db.count_participants(raffle["raffle_id"])
         button_text = f"ID: {raffle['raffle_id']} (Участников: {participants_count})"
         keyboard.append([InlineKeyboardButton(button_text, callback_data=f"info_{raffle['raffle_id']}")])
+    for raffle_id in archived_raffle_ids:
+        keyboard.append([InlineKeyboardButton(f"ID: {raffle_id} (Завершен)", callback_data=f"info_{raffle_id}")])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -486,12 +704,14 @@ async def raffle_info_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     
     info_text = f"📊 *Информация о розыгрыше* 📊\n\n"
     info_text += f"*ID розыгрыша:* {raffle_id}\n"
+    info_text += f"*Канал:* {channel_title(raffle)}\n"
     info_text += f"*Текст:* {raffle['text'][:100]}...\n"
     info_text += f"*Создан:* {created_at}\n"
     info_text += f"*Дата окончания:* {end_date}\n"
     info_text += f"*Статус:* {status}\n"
     info_text += f"*Количество победителей:* {winners_count}\n"
-    info_text += f"*Количество участников:* {participants_count}\n\n"
+    info_text += f"*Количество участников:* {participants_count}\n"
+    info_text += f"*Количество билетов:* {sum(p.get('tickets', 1) for p in participants)}\n\n"
     
     # Добавляем информацию о победителях, если розыгрыш завершен
     if not raffle.get("is_active", False):
@@ -530,6 +750,8 @@ async def raffle_info_callback(update: Update, context: ContextTypes.DEFAULT_TYP
                 info_text += f"{i}. {participant_name}"
                 if participant_username:
                     info_text += f" (@{participant_username})"
+                if participant.get("tickets", 1) > 1:
+                    info_text += f" - билетов: {participant['tickets']}"
                 info_text += "\n"
         else:
             info_text += "\n*Первые 30 участников:*\n"
@@ -542,6 +764,8 @@ async def raffle_info_callback(update: Update, context: ContextTypes.DEFAULT_TYP
                 info_text += f"{i}. {participant_name}"
                 if participant_username:
                     info_text += f" (@{participant_username})"
+                if participant.get("tickets", 1) > 1:
+                    info_text += f" - билетов: {participant['tickets']}"
                 info_text += "\n"
             
             info_text += f"\n...и еще {participants_count - 30} участников."
@@ -573,7 +797,7 @@ async def draw_winner_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Создаем клавиатуру для выбора розыгрыша
     keyboard = []
     for raffle in active_raffles:
-        participants_count = len(db.get_participants(raffle["raffle_id"]))
+        participants_count = db.count_participants(raffle["raffle_id"])
         winners_count = raffle.get("winners_count", 1)
         button_text = f"ID: {raffle['raffle_id']} (Уч.: {participants_count}, Поб.: {winners_count})"
         keyboard.append([InlineKeyboardButton(button_text, callback_data=f"draw_{raffle['raffle_id']}")])
@@ -599,6 +823,23 @@ async def draw_winner_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.edit_message_text("Этот розыгрыш уже завершен или не существует.")
         return
     
+    # Захватываем розыгрыш, чтобы победителей определил ровно один процесс бота,
+    # даже если несколько администраторов нажали кнопку одновременно
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+    if not db.begin_draw(raffle_id, owner):
+        await query.edit_message_text("Победители этого розыгрыша уже определяются или определены.")
+        return
+    
+    try:
+        await run_draw(query, context, raffle, owner)
+    finally:
+        # Если победители не были записаны, освобождаем розыгрыш для повторной попытки
+        db.release_draw(raffle_id, owner)
+
+async def run_draw(query, context: ContextTypes.DEFAULT_TYPE, raffle: dict, owner: str) -> None:
+    """Определение и объявление победителей захваченного розыгрыша."""
+    raffle_id = raffle["raffle_id"]
+    
     # Получаем список участников
     participants = db.get_participants(raffle_id)
     
@@ -617,41 +858,50 @@ async def draw_winner_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         return
     
-    # Проверяем подписку каждого участника на канал
-    valid_participants = []
+    # Выбираем победителей без повторений пропорционально количеству билетов.
+    # Порядок участников фиксируется снимком, а случайность берется из опубликованного сида,
+    # поэтому любой может повторить розыгрыш по протоколу (/draw_audit).
+    # Подписка проверяется только у выбранных кандидатов: отписавшийся кандидат исключается,
+    # и выбор продолжается, поэтому количество запросов к Telegram зависит от числа победителей, а не участников
+    participants_by_id = {participant["user_id"]: participant for participant in participants}
+    snapshot = draw_engine.make_snapshot(participants)
+    draw = draw_engine.Draw(snapshot, draw_engine.new_seed(), winners_count)
     
-    for participant in participants:
-        user_id = participant["user_id"]
+    while not draw.finished:
+        user_id = draw.next_candidate()
         try:
-            # Проверяем, подписан ли участник на канал
-            chat_member = await context.bot.get_chat_member(CHANNEL_USERNAME, user_id)
-            is_member = chat_member.status in ['member', 'administrator', 'creator']
+            # Проверяем, подписан ли кандидат на канал
+            is_member = await is_channel_member(context, raffle["chat_id"], user_id)
             
             if is_member:
-                valid_participants.append(participant)
+                draw.accept()
             else:
+                draw.reject(draw_engine.REJECT_NOT_MEMBER)
                 logger.info(f"Участник {user_id} больше не подписан на канал и исключен из розыгрыша")
         except Exception as e:
+            draw.reject(draw_engine.REJECT_CHECK_FAILED)
             logger.error(f"Ошибка при проверке подписки участника {user_id}: {e}")
             # В случае ошибки проверки (например, пользователь заблокировал бота)
             # мы исключаем участника из розыгрыша
     
-    # Проверяем, достаточно ли осталось валидных участников
-    if len(valid_participants) < winners_count:
+    # Проверяем, удалось ли набрать нужное количество подписанных победителей
+    if len(draw.winners) < winners_count:
         await query.edit_message_text(
-            f"В розыгрыше недостаточно действительных участников ({len(valid_participants)}) "
+            f"В розыгрыше недостаточно действительных участников ({len(draw.winners)}) "
             f"для выбора {winners_count} победителей. Некоторые участники отписались от канала."
         )
         return
     
-    # Выбираем случайных победителей без повторений из числа подписанных
-    winners = random.sample(valid_participants, winners_count)
+    # Собираем победителей и протокол розыгрыша
+    winner_ids = draw.winners
+    winners = [participants_by_id[winner_id] for winner_id in winner_ids]
+    transcript = draw.transcript(raffle_id)
     
-    # Собираем ID победителей
-    winner_ids = [winner["user_id"] for winner in winners]
-    
-    # Обновляем информацию о розыгрыше
-    db.set_winners(raffle_id, winner_ids)
+    # Обновляем информацию о розыгрыше. Запись выполняется только для активного
+    # розыгрыша, захваченного этим процессом, поэтому объявление не может быть отправлено дважды
+    if not db.set_winners(raffle_id, winner_ids, owner=owner, draw=transcript, snapshot=snapshot):
+        await query.edit_message_text("Победители этого розыгрыша уже определены.")
+        return
     
     # Формируем текст объявления победителей
     if winners_count == 1:
@@ -680,27 +930,209 @@ async def draw_winner_callback(update: Update, context: ContextTypes.DEFAULT_TYP
                 winner_text += f" (@{winner_username})"
             winner_text += "\n"
     
+    # Публикуем данные для независимой проверки результата
+    winner_text += (
+        f"\n\nСид розыгрыша: {transcript['seed']}\n"
+        f"Хэш списка участников: {transcript['snapshot_hash']}\n"
+        f"Проверить результат: /draw_audit {raffle_id} в боте"
+    )
+    
     # Отправляем сообщение в канал
     try:
         await context.bot.send_message(
-            chat_id=CHANNEL_USERNAME,
+            chat_id=raffle["chat_id"],
             text=winner_text,
-            reply_to_message_id=int(raffle_id)
+            reply_to_message_id=raffle["message_id"]
         )
         
         await query.edit_message_text(f"Победители успешно определены и объявлены в канале!")
     except Exception as e:
         logger.error(f"Error announcing winners: {e}")
         await query.edit_message_text(f"Ошибка при объявлении победителей: {str(e)}")
+    
+    # Розыгрыш завершен: переносим его и участников в архив, чтобы не замедлять активные розыгрыши
+    try:
+        db.archive_raffle(raffle_id)
+    except Exception as e:
+        logger.error(f"Ошибка при архивировании розыгрыша {raffle_id}: {e}")
+    # Счетчик участников завершенного розыгрыша больше не обновляется
+    context.bot_data.get("participant_counters", {}).pop(raffle_id, None)
 
-def main() -> None:
-    """Запуск бота."""
-    if not BOT_TOKEN or not CHANNEL_USERNAME:
-        logger.error("Пожалуйста, укажите BOT_TOKEN и CHANNEL_USERNAME в файле .env")
+async def draw_audit_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Выгрузка протокола розыгрыша и снимка участников для независимой проверки: /draw_audit <ID розыгрыша>."""
+    if not context.args:
+        await update.message.reply_text("Использование: /draw_audit <ID розыгрыша>")
         return
     
-    # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+    raffle_id = context.args[0]
+    audit = db.get_draw_audit(raffle_id)
+    if not audit:
+        await update.message.reply_text("Для этого розыгрыша нет протокола: он не существует или еще не проведен.")
+        return
+    
+    transcript = audit["transcript"]
+    rejected = sum(1 for candidate in transcript["candidates"] if not candidate["accepted"])
+    await update.message.reply_document(
+        document=json.dumps(audit, ensure_ascii=False).encode("utf-8"),
+        filename=f"draw_{raffle_id}.json",
+        caption=(
+            f"Протокол розыгрыша {raffle_id}\n"
+            f"Участников: {transcript['participants_count']}, билетов: {transcript['total_tickets']}\n"
+            f"Проверено кандидатов: {len(transcript['candidates'])}, исключено: {rejected}\n"
+            f"Повторить розыгрыш: python draw_engine.py draw_{raffle_id}.json"
+        )
+    )
+
+def start_broadcast_task(application: Application, job_id: str) -> None:
+    """Запускает выполнение рассылки в фоне."""
+    application.create_task(
+        application.bot_data["broadcasts"].run(application.bot, job_id),
+        name=f"broadcast_{job_id}"
+    )
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Рассылка участникам или победителям розыгрыша: /broadcast <ID розыгрыша> <participants|winners> <текст>."""
+    if not is_admin(context, update.effective_user.id):
+        await update.message.reply_text("Эта команда доступна только администраторам бота (ADMIN_IDS).")
+        return
+    
+    # Текст рассылки - все, что идет после двух аргументов, с сохранением переносов строк
+    parts = update.message.text.split(maxsplit=3)
+    if len(parts) < 4 or parts[2] not in ("participants", "winners"):
+        await update.message.reply_text(
+            "Использование: /broadcast <ID розыгрыша> <participants|winners> <текст сообщения>\n"
+            "participants - всем участникам, winners - только победителям."
+        )
+        return
+    
+    _, raffle_id, audience, text = parts
+    if not db.get_raffle(raffle_id):
+        await update.message.reply_text("Этот розыгрыш не существует.")
+        return
+    
+    job_id = db.create_broadcast(raffle_id, audience, text, update.effective_user.id)
+    start_broadcast_task(context.application, job_id)
+    
+    await update.message.reply_text(
+        f"Рассылка {job_id} запущена.\n"
+        f"Прогресс: /broadcast_status {job_id}\n"
+        f"Отмена: /broadcast_cancel {job_id}"
+    )
+
+async def broadcast_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Состояние рассылки: /broadcast_status <ID рассылки>."""
+    if not is_admin(context, update.effective_user.id):
+        await update.message.reply_text("Эта команда доступна только администраторам бота (ADMIN_IDS).")
+        return
+    
+    job = db.get_broadcast(context.args[0]) if context.args else None
+    if not job:
+        await update.message.reply_text("Использование: /broadcast_status <ID рассылки>")
+        return
+    
+    await update.message.reply_text(broadcast.format_status(job))
+
+async def broadcast_cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отмена рассылки: /broadcast_cancel <ID рассылки>."""
+    if not is_admin(context, update.effective_user.id):
+        await update.message.reply_text("Эта команда доступна только администраторам бота (ADMIN_IDS).")
+        return
+    
+    if not context.args or not db.cancel_broadcast(context.args[0]):
+        await update.message.reply_text("Рассылка не найдена или уже завершена.")
+        return
+    
+    await update.message.reply_text("Рассылка будет остановлена после отправки текущего пакета.")
+
+async def click_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Счетчики слоя допуска нажатий 'Участвую' в этом процессе бота."""
+    if not is_admin(context, update.effective_user.id):
+        await update.message.reply_text("Эта команда доступна только администраторам бота (ADMIN_IDS).")
+        return
+    
+    click_admission = context.bot_data["click_admission"]
+    counters = click_admission.counters
+    await update.message.reply_text(
+        "Нажатия \"Участвую\" с момента запуска:\n"
+        f"Допущено к обработке: {counters[admission.ADMITTED]}\n"
+        f"Отклонено (слишком часто): {counters[admission.RATE_LIMITED]}\n"
+        f"Отклонено (уже обрабатывается): {counters[admission.DUPLICATE]}\n"
+        f"Отклонено (перегрузка): {counters[admission.OVERLOADED]}\n"
+        f"Обрабатывается сейчас: {click_admission.in_flight} из {click_admission.max_in_flight}"
+    )
+
+async def post_init(application: Application) -> None:
+    """Действия после инициализации приложения (состояние бота уже загружено из хранилища)."""
+    await migrate_legacy_storage(application)
+    
+    # Переводим участников, сохраненных в JSON, в компактный формат
+    converted = db.convert_participants_storage()
+    if converted:
+        logger.info(f"Участники переведены в компактный формат в каналах: {converted}")
+    
+    # Архивируем розыгрыши, завершенные до перезапуска, но не успевшие попасть в архив
+    archived = db.archive_finished_raffles()
+    if archived:
+        logger.info(f"Перенесено в архив завершенных розыгрышей: {archived}")
+    
+    # Продолжаем рассылки, прерванные перезапуском или брошенные упавшими процессами
+    application.create_task(
+        application.bot_data["broadcasts"].supervise(application.bot),
+        name="broadcast_supervisor"
+    )
+    
+    # Отчет о времени запуска
+    startup = application.bot_data.get("startup", {})
+    ready_ms = (time.perf_counter() - startup.get("started_at", time.perf_counter())) * 1000
+    logger.info(
+        f"Бот готов к работе за {ready_ms:.1f} мс: "
+        f"хранилище {startup.get('storage_ms', 0):.1f} мс "
+        f"(удалено незавершенных записей: {startup.get('recovered', 0)}), "
+        f"восстановлено данных пользователей: {len(application.user_data)}"
+    )
+
+async def migrate_legacy_storage(application: Application) -> None:
+    """Перенос данных старого формата (один канал) в хранилище канала."""
+    if not db.has_legacy_storage():
+        return
+    
+    # Старые розыгрыши всегда публиковались в канал из CHANNEL_USERNAME (или в первый канал списка)
+    config = application.bot_data["config"]
+    legacy_channel = config["channel_username"] or config["channel_usernames"][0]
+    try:
+        chat = await application.bot.get_chat(legacy_channel)
+        migrated = db.migrate_legacy_storage(chat.id, legacy_channel)
+        logger.info(f"Перенесено розыгрышей старого формата в канал {legacy_channel}: {migrated}")
+    except Exception as e:
+        logger.error(f"Не удалось перенести данные старого формата в канал {legacy_channel}: {e}")
+
+def build_application(config: Dict[str, Any]) -> Application:
+    """
+    Создает экземпляр бота со всеми обработчиками.
+
+    Хранилище должно быть подключено заранее (db.init_storage). Настройки, слой допуска нажатий и исполнитель
+    рассылок принадлежат экземпляру (bot_data), поэтому тесты и бенчмарки могут создавать в одном процессе
+    несколько независимых экземпляров, каждый со своим хранилищем в памяти.
+    """
+    # Создаем приложение. Данные пользователей и состояния разговоров сохраняются в хранилище,
+    # поэтому незавершенное создание розыгрыша продолжается после перезапуска
+    application = (
+        Application.builder()
+        .token(config["bot_token"])
+        .persistence(StoragePersistence(update_interval=config["persistence_interval"]))
+        .post_init(post_init)
+        .build()
+    )
+    application.bot_data["config"] = config
+    application.bot_data["click_admission"] = admission.ClickAdmission(
+        user_rate=config["click_rate"],
+        user_burst=config["click_burst"],
+        max_in_flight=config["max_in_flight_clicks"]
+    )
+    application.bot_data["broadcasts"] = broadcast.BroadcastRunner(
+        rate=config["broadcast_rate"],
+        workers=config["broadcast_workers"]
+    )
     
     # Добавляем обработчик для создания розыгрыша
     # ВАЖНО: ConversationHandler должен быть добавлен ПЕРВЫМ, 
@@ -731,6 +1163,12 @@ def main() -> None:
                 # Обработка команды отмены
                 CommandHandler("cancel", cancel)
             ],
+            CHANNEL: [
+                # Обработка выбора канала для публикации
+                CallbackQueryHandler(raffle_channel_callback, pattern="^channel_"),
+                # Обработка команды отмены
+                CommandHandler("cancel", cancel)
+            ],
         },
         fallbacks=[
             CommandHandler("cancel", cancel),
@@ -741,8 +1179,9 @@ def main() -> None:
         conversation_timeout=CONVERSATION_TIMEOUT,
         # Разрешаем запускать разговор заново при новой команде /create_raffle
         allow_reentry=True,
-        # Название для журналирования
-        name="raffle_creation"
+        # Название для журналирования и сохранения состояния между перезапусками
+        name="raffle_creation",
+        persistent=True
     )
     application.add_handler(conv_handler)
 
@@ -754,14 +1193,60 @@ def main() -> None:
     application.add_handler(CommandHandler("list_raffles", list_raffles))
     application.add_handler(CommandHandler("raffle_info", raffle_info_start))
     application.add_handler(CommandHandler("draw_winner", draw_winner_start))
+    application.add_handler(CommandHandler("add_tickets", add_tickets_command))
+    application.add_handler(CommandHandler("raffle_stats", raffle_stats_command))
+    application.add_handler(CommandHandler("draw_audit", draw_audit_command))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("broadcast_status", broadcast_status_command))
+    application.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel_command))
+    application.add_handler(CommandHandler("click_stats", click_stats_command))
     
     # Добавляем обработчики callback запросов
-    application.add_handler(CallbackQueryHandler(participate_callback, pattern="^participate$"))
+    # Нажатия "Участвую" обрабатываются параллельно (их количество ограничивает ClickAdmission),
+    # остальные обновления - по одному: ConversationHandler требует последовательной обработки
+    application.add_handler(CallbackQueryHandler(participate_callback, pattern="^participate$", block=False))
     application.add_handler(CallbackQueryHandler(draw_winner_callback, pattern="^draw_"))
     application.add_handler(CallbackQueryHandler(raffle_info_callback, pattern="^info_"))
     
+    return application
+
+def main() -> None:
+    """Запуск бота."""
+    # Настройка логирования
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    )
+    
+    config = load_config()
+    if not config["bot_token"] or not config["channel_usernames"]:
+        logger.error("Пожалуйста, укажите BOT_TOKEN и CHANNEL_USERNAMES (или CHANNEL_USERNAME) в файле .env")
+        return
+    
+    started_at = time.perf_counter()
+    
+    # Подключаем хранилище данных и удаляем следы записей, прерванных при прошлом завершении
+    db.init_storage(config["storage_path"], backend=config["storage_backend"])
+    recovered = db.recover_storage()
+    storage_ms = (time.perf_counter() - started_at) * 1000
+    
+    application = build_application(config)
+    application.bot_data["startup"] = {
+        "started_at": started_at,
+        "storage_ms": storage_ms,
+        "recovered": recovered
+    }
+    
     # Запускаем бота
-    application.run_polling()
+    if config["webhook_url"]:
+        # Все процессы регистрируют один и тот же адрес, поэтому повторная установка webhook безопасна
+        application.run_webhook(
+            listen=config["webhook_listen"],
+            port=config["webhook_port"],
+            webhook_url=config["webhook_url"],
+            secret_token=config["webhook_secret"]
+        )
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,165 @@
+from copy import deepcopy
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import database as db
+
+# Состояние бота хранится в том же хранилище, что и розыгрыши:
+#   bot_state/user_data/<user_id>.json - данные пользователя (черновик создаваемого розыгрыша)
+#   bot_state/conversations/<name>/<chat_id>,<user_id>.json - состояние одного разговора ConversationHandler
+# Каждый пользователь и каждый разговор - отдельный документ, поэтому процессы бота с общим хранилищем
+# не перезаписывают данные друг друга.
+USER_DATA_PREFIX = 'bot_state/user_data/'
+CONVERSATIONS_PREFIX = 'bot_state/conversations/'
+
+
+def _encode(value: Any) -> Any:
+    """Подготавливает данные пользователя к сохранению в JSON (datetime сохраняется отдельно)."""
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, dict):
+        return {str(key): _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    return value
+
+
+def _conversation_key(name: str, key: tuple) -> str:
+    # Ключ разговора - кортеж (chat_id, user_id), в имени документа он хранится строкой "chat_id,user_id"
+    return f"{CONVERSATIONS_PREFIX}{name}/{','.join(str(part) for part in key)}.json"
+
+
+def _decode(value: Any) -> Any:
+    """Восстанавливает данные пользователя, сохраненные через _encode."""
+    if isinstance(value, dict):
+        if set(value) == {"__datetime__"}:
+            return datetime.fromisoformat(value["__datetime__"])
+        return {key: _decode(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+
+class StoragePersistence(BasePersistence):
+    """
+    Persistence для Application поверх хранилища database.py.
+
+    Сохраняет данные пользователей и состояния разговоров (например, незавершенное создание розыгрыша),
+    чтобы они переживали перезапуск бота. Каждый пользователь хранится в отдельном небольшом документе,
+    а запись выполняется атомарно с контрольной суммой, как и для остальных данных.
+    """
+
+    def __init__(self, update_interval: float = 5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._conversations: Dict[str, Dict] = {}
+        # Последние сохраненные этим процессом данные пользователей: неизмененные данные не перезаписываются
+        self._saved_user_data: Dict[int, Any] = {}
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        user_data = {}
+        for key in db.list_documents(USER_DATA_PREFIX):
+            user_id = int(key[len(USER_DATA_PREFIX):].split('.')[0])
+            document = db.load_document(key)
+            self._saved_user_data[user_id] = document
+            user_data[user_id] = _decode(document)
+        return user_data
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def get_callback_data(self) -> Optional[Any]:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict:
+        prefix = f"{CONVERSATIONS_PREFIX}{name}/"
+        conversations = {}
+        for key in db.list_documents(prefix):
+            conv_key = tuple(int(part) for part in key[len(prefix):-len('.json')].split(','))
+            conversations[conv_key] = db.load_document(key)["state"]
+
+        # Разговоры, сохраненные предыдущей версией бота одним документом на ConversationHandler
+        legacy_key = f"{CONVERSATIONS_PREFIX}{name}.json"
+        legacy = db.load_document(legacy_key)
+        if legacy:
+            for key, state in legacy.items():
+                conv_key = tuple(int(part) for part in key.split(','))
+                if conv_key not in conversations:
+                    db.save_document(_conversation_key(name, conv_key), {"state": state})
+                    conversations[conv_key] = state
+            db.delete_document(legacy_key)
+
+        self._conversations[name] = conversations
+        return deepcopy(conversations)
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        conversations = self._conversations.setdefault(name, {})
+        if new_state is None:
+            if key not in conversations:
+                return
+            del conversations[key]
+            db.delete_document(_conversation_key(name, key))
+        else:
+            if conversations.get(key) == new_state:
+                return
+            conversations[key] = new_state
+            db.save_document(_conversation_key(name, key), {"state": new_state})
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        if not data:
+            # PTB передает и пустые данные каждого пользователя, приславшего обновление (например, нажатие
+            # "Участвую"): удаляем только документ, который этот процесс сохранял или загружал (данные очищены)
+            if self._saved_user_data.pop(user_id, None) is not None:
+                db.delete_document(f"{USER_DATA_PREFIX}{user_id}.json")
+            return
+        document = _encode(data)
+        if self._saved_user_data.get(user_id) == document:
+            return
+        db.save_document(f"{USER_DATA_PREFIX}{user_id}.json", document)
+        self._saved_user_data[user_id] = document
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._saved_user_data.pop(user_id, None)
+        db.delete_document(f"{USER_DATA_PREFIX}{user_id}.json")
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        """Перечитывает данные пользователя, если их изменил другой процесс бота."""
+        document = db.load_document(f"{USER_DATA_PREFIX}{user_id}.json")
+        # Документ не менялся с последнего сохранения или загрузки этим процессом: данные в памяти
+        # актуальнее (они могут быть еще не сохранены)
+        if document == self._saved_user_data.get(user_id, {}):
+            return
+        user_data.clear()
+        user_data.update(_decode(document))
+        if document:
+            self._saved_user_data[user_id] = document
+        else:
+            self._saved_user_data.pop(user_id, None)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        pass
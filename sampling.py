@@ -0,0 +1,80 @@
+import random
+from typing import Sequence
+
+# Взвешенный выбор без возвращения на дереве Фенвика.
+# Каждый участник - элемент с целым весом (количество билетов). Выбор одного элемента
+# пропорционально весу и его исключение занимают O(log n), построение - O(n),
+# поэтому k победителей из n участников выбираются за O(n + k log n).
+
+
+class FenwickTree:
+    """Дерево Фенвика (двоичное индексированное дерево) над неотрицательными целыми весами."""
+
+    def __init__(self, weights: Sequence[int]):
+        self.size = len(weights)
+        self._tree = [0] * (self.size + 1)
+        self.total = 0
+        for index, weight in enumerate(weights):
+            if weight < 0:
+                raise ValueError("Вес не может быть отрицательным")
+            self.total += weight
+            position = index + 1
+            self._tree[position] += weight
+            parent = position + (position & -position)
+            if parent <= self.size:
+                self._tree[parent] += self._tree[position]
+
+        # Старший бит размера - начальный шаг двоичного спуска в find()
+        self._top_bit = 1 << (self.size.bit_length() - 1) if self.size else 0
+
+    def add(self, index: int, delta: int) -> None:
+        """Прибавляет delta к весу элемента index."""
+        self.total += delta
+        position = index + 1
+        while position <= self.size:
+            self._tree[position] += delta
+            position += position & -position
+
+    def find(self, value: int) -> int:
+        """
+        Возвращает индекс элемента, на который приходится value (0 <= value < total):
+        наименьший index, для которого сумма весов элементов 0..index больше value.
+        """
+        if not 0 <= value < self.total:
+            raise ValueError("Значение вне диапазона суммы весов")
+
+        position = 0
+        step = self._top_bit
+        while step:
+            next_position = position + step
+            if next_position <= self.size and self._tree[next_position] <= value:
+                position = next_position
+                value -= self._tree[next_position]
+            step >>= 1
+        return position
+
+
+class WeightedSampler:
+    """
+    Выбор элементов без возвращения с вероятностью, пропорциональной весу.
+
+    Элементы выбираются по одному через draw(), поэтому вызывающий код может проверять
+    каждого кандидата (например, подписку на канал) и продолжать выбор, пока не наберет нужное количество.
+    """
+
+    def __init__(self, weights: Sequence[int]):
+        self._weights = list(weights)
+        self._tree = FenwickTree(self._weights)
+        self.remaining = sum(1 for weight in self._weights if weight > 0)
+
+    def draw(self, rng: random.Random) -> int:
+        """Выбирает индекс элемента пропорционально весу и исключает его из дальнейшего выбора."""
+        if self._tree.total <= 0:
+            raise IndexError("Не осталось элементов для выбора")
+
+        index = self._tree.find(rng.randrange(self._tree.total))
+        self._tree.add(index, -self._weights[index])
+        self._weights[index] = 0
+        self.remaining -= 1
+        return index
+
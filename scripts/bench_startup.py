@@ -0,0 +1,103 @@
+"""
+Бенчмарк запуска бота: время импорта модулей и холодный старт изолированных экземпляров в памяти.
+
+1. Каждый модуль импортируется в отдельном процессе из пустой директории. Импорт не должен
+   создавать файлов (директория data/ появляется только при подключении хранилища).
+2. В одном процессе одновременно запускается несколько экземпляров бота, каждый со своим
+   хранилищем в памяти: подключение хранилища, создание приложения, загрузка состояния бота
+   и запись участников. Каждый экземпляр должен видеть только свои данные.
+
+Запуск: python scripts/bench_startup.py [количество_экземпляров]
+"""
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MODULES = ["database", "main"]
+IMPORT_RUNS = 5
+PARTICIPANTS = 200
+
+
+def measure_import(module: str):
+    """Медианное время импорта модуля (мс) и файлы, созданные импортом."""
+    code = f"import time; started = time.perf_counter(); import {module}; print((time.perf_counter() - started) * 1000)"
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    timings = []
+    created = []
+    for _ in range(IMPORT_RUNS):
+        with tempfile.TemporaryDirectory() as directory:
+            output = subprocess.run(
+                [sys.executable, "-c", code], cwd=directory, env=env, capture_output=True, text=True, check=True
+            ).stdout
+            timings.append(float(output.strip().splitlines()[-1]))
+            created = os.listdir(directory)
+    return statistics.median(timings), created
+
+
+async def cold_start(instance: int, config: dict):
+    """Запускает один экземпляр бота с хранилищем в памяти. Возвращает (время запуска в мс, участников)."""
+    import database as db
+    import main
+
+    started = time.perf_counter()
+    # Хранилище выбирается внутри задачи, поэтому другие экземпляры его не видят
+    db.init_storage(backend='memory')
+    db.recover_storage()
+    application = main.build_application(config)
+    await application.persistence.get_user_data()
+    await application.persistence.get_conversations("raffle_creation")
+    db.convert_participants_storage()
+    db.archive_finished_raffles()
+    startup_ms = (time.perf_counter() - started) * 1000
+
+    chat_id = -1000000000000 - instance
+    raffle_id = db.create_raffle(chat_id, 1, f"Экземпляр {instance}", "2030-01-01T00:00:00")
+    for user_id in range(1, PARTICIPANTS + 1):
+        db.add_participant(raffle_id, user_id, f"user{user_id}", "Имя", "")
+        # Отдаем управление, чтобы экземпляры работали вперемешку
+        await asyncio.sleep(0)
+
+    isolated = db.get_channel_ids() == [chat_id] and db.count_participants(raffle_id) == PARTICIPANTS
+    return startup_ms, isolated
+
+
+async def run_instances(count: int):
+    import main
+
+    config = dict(main.load_config(), bot_token="123456:TEST", channel_usernames=["@bench"])
+    return await asyncio.gather(*(cold_start(instance, config) for instance in range(count)))
+
+
+def main() -> None:
+    instances = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    ok = True
+
+    for module in MODULES:
+        import_ms, created = measure_import(module)
+        print(f"Импорт {module}: {import_ms:.1f} мс, создано файлов: {len(created)}")
+        ok = ok and not created
+
+    started = time.perf_counter()
+    results = asyncio.run(run_instances(instances))
+    total_ms = (time.perf_counter() - started) * 1000
+    startup = [startup_ms for startup_ms, _ in results]
+    isolated = sum(1 for _, isolated in results if isolated)
+
+    print(f"Экземпляров: {instances}, общее время: {total_ms:.1f} мс")
+    print(f"Холодный старт экземпляра: медиана {statistics.median(startup):.1f} мс, максимум {max(startup):.1f} мс")
+    print(f"Изолированных экземпляров: {isolated} из {instances}")
+
+    ok = ok and isolated == instances
+    print("OK" if ok else "ОШИБКА")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Проверка общего хранилища SQLite несколькими процессами на одной машине.
+
+Несколько процессов одновременно добавляют одних и тех же участников в один розыгрыш
+и пытаются определить победителей. Ожидается, что каждый участник записан ровно один раз,
+а победителей записал ровно один процесс.
+
+Запуск: python scripts/check_shared_storage.py [количество_процессов]
+"""
+import os
+import sys
+import tempfile
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database as db
+
+CHAT_ID = -1000000000001
+MESSAGE_ID = 1
+USERS = 200
+
+
+def worker(args):
+    path, worker_id = args
+    db.init_storage(path, backend='sqlite')
+    raffle_id = db.make_raffle_id(CHAT_ID, MESSAGE_ID)
+
+    added = 0
+    for user_id in range(1, USERS + 1):
+        if db.add_participant(raffle_id, user_id, f"user{user_id}", "Имя", ""):
+            added += 1
+
+    owner = f"worker-{worker_id}"
+    drawn = db.begin_draw(raffle_id, owner) and db.set_winners(raffle_id, [worker_id], owner=owner)
+    return added, drawn
+
+
+def main() -> None:
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'shared.sqlite3')
+        db.init_storage(path, backend='sqlite')
+        raffle_id = db.create_raffle(CHAT_ID, MESSAGE_ID, "Проверка", "2030-01-01T00:00:00", 1)
+
+        with Pool(processes) as pool:
+            results = pool.map(worker, [(path, worker_id) for worker_id in range(1, processes + 1)])
+
+        total_added = sum(added for added, _ in results)
+        draws = sum(1 for _, drawn in results if drawn)
+        participants = len(db.get_participants(raffle_id))
+        raffle = db.get_raffle(raffle_id)
+
+        print(f"Процессов: {processes}")
+        print(f"Добавлено участников: {total_added}, в хранилище: {participants}")
+        print(f"Успешных определений победителей: {draws}, победители: {raffle['winners']}")
+
+        ok = total_added == USERS and participants == USERS and draws == 1 and not raffle['is_active']
+        print("OK" if ok else "ОШИБКА")
+        sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+import mmap
+import os
+import shutil
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Union
+
+# Хранилища документов для database.py.
+# Документ - это произвольные байты под строковым ключом вида "channels/<chat_id>/raffles.json".
+# Все операции чтения-изменения-записи выполняются внутри transaction(),
+# которая гарантирует, что другие потоки (и процессы - для SQLite) не изменят данные между чтением и записью.
+
+# Суффиксы служебных файлов FileStorage: незавершенная запись и предыдущая версия документа
+TEMP_SUFFIX = '.tmp'
+BACKUP_SUFFIX = '.bak'
+
+
+def _fsync_directory(directory: str) -> None:
+    """Сбрасывает на диск запись каталога, чтобы переименование пережило сбой питания."""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class FileStorage:
+    """Хранилище в файлах директории root. Подходит для одного процесса бота."""
+
+    def __init__(self, root: str):
+        self.root = root
+        # Директория, в которой ищутся файлы старого формата (raffles.json, participants.json)
+        self.legacy_dir: Optional[str] = root
+        self._lock = threading.RLock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split('/'))
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Блокировка внутри процесса на время чтения-изменения-записи."""
+        with self._lock:
+            yield
+
+    def read(self, key: str) -> Optional[bytes]:
+        """Возвращает содержимое документа или None, если его нет."""
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def read_mapped(self, key: str) -> Optional[Union[mmap.mmap, bytes]]:
+        """
+        Отображает документ в память только для чтения (mmap) или возвращает None, если его нет.
+
+        Запись заменяет файл документа новым (os.replace), поэтому уже отображенная версия не меняется.
+        """
+        try:
+            with open(self._path(key), 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return b''
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+    def read_backup(self, key: str) -> Optional[bytes]:
+        """Возвращает предыдущую версию документа (снимок до последней записи) или None."""
+        try:
+            with open(self._path(key) + BACKUP_SUFFIX, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, key: str, value: bytes) -> None:
+        """
+        Атомарно сохраняет документ.
+
+        Новое содержимое пишется во временный файл и после fsync заменяет документ через os.replace,
+        поэтому при сбое на диске остается либо старая, либо новая версия целиком.
+        Предыдущая версия сохраняется рядом как *.bak (жесткой ссылкой, без копирования).
+        """
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        temp_path = path + TEMP_SUFFIX
+        with open(temp_path, 'wb') as f:
+            f.write(value)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if os.path.exists(path):
+            backup_path = path + BACKUP_SUFFIX
+            try:
+                os.remove(backup_path)
+            except FileNotFoundError:
+                pass
+            try:
+                os.link(path, backup_path)
+            except OSError:
+                # Файловая система без жестких ссылок
+                shutil.copy2(path, backup_path)
+
+        os.replace(temp_path, path)
+        _fsync_directory(directory)
+
+    def delete(self, key: str) -> None:
+        """Удаляет документ, если он существует."""
+        for path in (self._path(key), self._path(key) + BACKUP_SUFFIX):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def recover(self) -> int:
+        """Удаляет временные файлы незавершенных записей. Возвращает количество удаленных файлов."""
+        removed = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith(TEMP_SUFFIX):
+                    os.remove(os.path.join(dirpath, filename))
+                    removed += 1
+        return removed
+
+    def list_keys(self, prefix: str = '') -> List[str]:
+        """
+        Возвращает отсортированный список ключей, начинающихся с prefix.
+
+        Обходится только директория префикса (для "channels/" - data/channels), а не весь корень,
+        поэтому время не зависит от объема архивов, статистики и состояния бота.
+        """
+        keys = []
+        directory = prefix.rsplit('/', 1)[0] if '/' in prefix else ''
+        start = os.path.join(self.root, *directory.split('/')) if directory else self.root
+        for dirpath, _, filenames in os.walk(start):
+            relative = os.path.relpath(dirpath, self.root)
+            for filename in filenames:
+                if filename.endswith((TEMP_SUFFIX, BACKUP_SUFFIX)):
+                    continue
+                key = filename if relative == '.' else '/'.join(relative.split(os.sep) + [filename])
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+
+class MemoryStorage:
+    """
+    Хранилище в памяти процесса: для тестов, бенчмарков и изолированных экземпляров бота.
+    Данные теряются при завершении процесса.
+    """
+
+    def __init__(self):
+        # У хранилища в памяти нет файлов старого формата: экземпляр бота не трогает файлы на диске
+        self.legacy_dir: Optional[str] = None
+        self._documents: Dict[str, bytes] = {}
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        with self._lock:
+            yield
+
+    def read(self, key: str) -> Optional[bytes]:
+        return self._documents.get(key)
+
+    def read_mapped(self, key: str) -> Optional[bytes]:
+        return self._documents.get(key)
+
+    def read_backup(self, key: str) -> Optional[bytes]:
+        # Документ в памяти заменяется целиком, частично записанных документов не бывает
+        return None
+
+    def write(self, key: str, value: bytes) -> None:
+        self._documents[key] = bytes(value)
+
+    def delete(self, key: str) -> None:
+        self._documents.pop(key, None)
+
+    def recover(self) -> int:
+        return 0
+
+    def list_keys(self, prefix: str = '') -> List[str]:
+        return sorted(key for key in self._documents if key.startswith(prefix))
+
+
+# Сколько секунд SQLite ждет блокировку, которую держит другой процесс. Хранилище вызывается синхронно
+# из обработчиков бота, поэтому ожидание останавливает весь цикл событий процесса: транзакции бота
+# короткие, и если блокировку не удалось получить за это время, лучше вернуть ошибку (sqlite3.OperationalError),
+# чем задерживать все остальные обновления
+BUSY_TIMEOUT = 2.0
+
+
+class SqliteStorage:
+    """
+    Хранилище в одном файле SQLite, общее для нескольких процессов бота.
+
+    transaction() открывает транзакцию BEGIN IMMEDIATE, поэтому чтение-изменение-запись
+    в разных процессах выполняются строго по очереди.
+    """
+
+    def __init__(self, path: str, timeout: float = BUSY_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.legacy_dir: Optional[str] = os.path.dirname(path) or '.'
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS documents (key TEXT PRIMARY KEY, value BLOB NOT NULL)"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        # Соединение SQLite нельзя использовать из разных потоков, поэтому у каждого потока своё
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self._local.connection = connection
+            self._local.depth = 0
+        return connection
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Межпроцессная транзакция. Вложенные вызовы выполняются в рамках внешней транзакции."""
+        connection = self._connection()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+
+        connection.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        else:
+            connection.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    def read_backup(self, key: str) -> Optional[bytes]:
+        # Транзакции SQLite не оставляют частично записанных документов, резервные копии не нужны
+        return None
+
+    def recover(self) -> int:
+        # Незавершенные транзакции откатываются самим SQLite при открытии базы
+        return 0
+
+    def read(self, key: str) -> Optional[bytes]:
+        row = self._connection().execute(
+            "SELECT value FROM documents WHERE key = ?", (key,)
+        ).fetchone()
+        return bytes(row[0]) if row else None
+
+    def read_mapped(self, key: str) -> Optional[bytes]:
+        # Документы SQLite не отображаются в память, читаем их целиком
+        return self.read(key)
+
+    def write(self, key: str, value: bytes) -> None:
+        self._connection().execute(
+            "INSERT INTO documents (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, sqlite3.Binary(value))
+        )
+
+    def delete(self, key: str) -> None:
+        self._connection().execute("DELETE FROM documents WHERE key = ?", (key,))
+
+    def list_keys(self, prefix: str = '') -> List[str]:
+        rows = self._connection().execute(
+            "SELECT key FROM documents WHERE substr(key, 1, ?) = ? ORDER BY key",
+            (len(prefix), prefix)
+        ).fetchall()
+        return [row[0] for row in rows]
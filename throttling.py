@@ -0,0 +1,43 @@
+import asyncio
+import time
+from typing import Callable
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты "ведро с токенами".
+
+    Ведро вмещает capacity токенов и пополняется со скоростью rate токенов в секунду.
+    Каждое действие расходует один токен, поэтому в среднем выполняется не больше rate действий в секунду,
+    а кратковременно - не больше capacity подряд.
+    """
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated_at = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """Расходует токены, если они есть. Возвращает False, если действие нужно отложить."""
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    def pause(self, seconds: float) -> None:
+        """Останавливает выдачу токенов на seconds секунд (например, после ответа RetryAfter от Telegram)."""
+        self._refill()
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        """Ждет, пока в ведре появятся токены, и расходует их."""
+        while not self.try_acquire(tokens):
+            await asyncio.sleep((tokens - self._tokens) / self.rate)